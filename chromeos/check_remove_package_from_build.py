@@ -0,0 +1,323 @@
+## checks for remove_package_from_build.py, run inside the chroot:
+##
+##   python check_remove_package_from_build.py [--trials 300] [--seed 0]
+##
+## minimal_cut: on random small reverse dependency graphs, the cut found by
+## `ReverseDependencyGraph.minimal_cut` is valid (nothing left depends on
+## the target) and costs the same as the best one found by brute force
+##
+## lex_ebuild: the events for nested, negated and || DEPEND strings, atoms
+## with use dependency defaults, and that comments and other strings between
+## declarations are skipped
+##
+## reverse dependency index: over a small overlay, names that look
+## versioned (dev-rust/serde, font-adobe-100dpi) are kept as they are, the
+## closure follows dependents through them, and blockers aren't dependents
+##
+## EbuildIndex.which: versioned atoms with each operator, and slots, find
+## the best matching ebuild, or nothing
+##
+## version_key: a list of versions in ascending portage order sorts back
+## into that order
+
+import os
+import sys
+import random
+import argparse
+import itertools
+import tempfile
+
+import remove_package_from_build as rpb
+
+
+class GraphIndex:
+    """stands in for `REVDEP_INDEX`, over a fixed graph"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+
+def random_graph(rng, n):
+    """package -> [(dependent, useflag)], with conditional and !flag edges"""
+    names = [f"app-misc/p{i}" for i in range(n)]
+    graph = {}
+    for _ in range(rng.randint(1, 2 * n)):
+        target, dependent = rng.sample(names, 2)
+        flag = rng.choice([None, None, "x", "y", "!z"])
+        graph.setdefault(target, []).append((dependent, flag))
+    return names, graph
+
+
+def cost(graph, target, package_masks, use_masks, mask_cost):
+    """
+    the cost of a plan, or None if something still depends on `target`
+    """
+    removed = {target} | set(package_masks)
+    for t in removed:
+        for d, f in graph.edges(t):
+            if d not in removed and not (f and (d, f) in use_masks):
+                return None
+    return len(use_masks) + mask_cost * len(package_masks)
+
+
+def brute_force(graph, target, mask_cost):
+    """the cheapest plan, trying every set of use masks"""
+    closure = graph.closure([target])
+    flags = sorted(
+        {(d, f) for p in [target, *closure] for d, f in graph.edges(p) if f}
+    )
+    best = None
+    for k in range(len(flags) + 1):
+        for use_masks in itertools.combinations(flags, k):
+            use_masks = set(use_masks)
+            # everything still reachable has to be masked
+            removed = {target}
+            queue = [target]
+            for t in queue:
+                for d, f in graph.edges(t):
+                    if f and (d, f) in use_masks:
+                        continue
+                    if d not in removed:
+                        removed.add(d)
+                        queue.append(d)
+            c = len(use_masks) + mask_cost * (len(removed) - 1)
+            if best is None or c < best:
+                best = c
+    return best
+
+
+def check_minimal_cut(trials, seed):
+    rng = random.Random(seed)
+    for trial in range(trials):
+        names, edges = random_graph(rng, rng.randint(2, 9))
+        graph = rpb.ReverseDependencyGraph(index=GraphIndex(edges))
+        target = names[0]
+        mask_cost = rng.choice([1, 2, 5])
+        plan = graph.minimal_cut([target], mask_cost=mask_cost)
+        found = cost(
+            graph,
+            target,
+            plan["package_masks"],
+            set(plan["package_use_masks"]),
+            mask_cost,
+        )
+        assert found is not None, f"trial {trial}: invalid cut {plan} of {edges}"
+        best = brute_force(graph, target, mask_cost)
+        assert found == best, f"trial {trial}: cut costs {found}, not {best}: {edges}"
+    print(f"minimal_cut: {trials} random graphs ok")
+
+
+EBUILD = """# Copyright "not=a declaration"
+EAPI=7
+IUSE="cups +ssl" # trailing comment="skipped"
+echo "RDEPEND=\\"skipped\\""
+RDEPEND="
+\tdev-libs/bar
+\tcups? ( net-print/cups !ssl? ( dev-libs/gnutls ) )
+\t|| ( a/b c/d )
+\t!<dev-libs/old-2
+\tdev-libs/openssl:0=[static-libs(+)] x/z[x(-)?]
+"
+DEPEND+="${RDEPEND} x/y[foo?]"
+"""
+
+LEXER_EVENTS = [
+    ("declaration", ("IUSE", False)),
+    ("token", "cups"),
+    ("token", "+ssl"),
+    ("end", "cups +ssl"),
+    ("declaration", ("RDEPEND", False)),
+    ("token", "dev-libs/bar"),
+    ("conditional", "cups?"),
+    ("paren", "("),
+    ("token", "net-print/cups"),
+    ("conditional", "!ssl?"),
+    ("paren", "("),
+    ("token", "dev-libs/gnutls"),
+    ("paren", ")"),
+    ("paren", ")"),
+    ("operator", "||"),
+    ("paren", "("),
+    ("token", "a/b"),
+    ("token", "c/d"),
+    ("paren", ")"),
+    ("token", "!<dev-libs/old-2"),
+    ("token", "dev-libs/openssl:0=[static-libs(+)]"),
+    ("token", "x/z[x(-)?]"),
+    (
+        "end",
+        "\n\tdev-libs/bar\n\tcups? ( net-print/cups !ssl? ( dev-libs/gnutls ) )"
+        "\n\t|| ( a/b c/d )\n\t!<dev-libs/old-2"
+        "\n\tdev-libs/openssl:0=[static-libs(+)] x/z[x(-)?]\n",
+    ),
+    ("declaration", ("DEPEND", True)),
+    ("token", "${RDEPEND}"),
+    ("token", "x/y[foo?]"),
+    ("end", "${RDEPEND} x/y[foo?]"),
+]
+
+
+def check_lexer():
+    events = list(rpb.lex_ebuild(EBUILD))
+    for i, (got, expected) in enumerate(itertools.zip_longest(events, LEXER_EVENTS)):
+        assert got == expected, f"event {i}: {got}, expected {expected}"
+    # an unterminated value ends with the content
+    events = list(rpb.lex_ebuild('RDEPEND="a/b ( c/d'))
+    assert events[-1] == ("end", "a/b ( c/d"), events
+    print(f"lex_ebuild: {len(LEXER_EVENTS)} events ok")
+
+
+CP_NAMES = {
+    "dev-rust/serde": "dev-rust/serde",
+    "dev-ruby/rake": "dev-ruby/rake",
+    "media-fonts/font-adobe-100dpi": "media-fonts/font-adobe-100dpi",
+    ">=dev-rust/serde-1.0.100-r2:0=[std(+)]": "dev-rust/serde",
+    "=media-fonts/font-adobe-100dpi-1.0*": "media-fonts/font-adobe-100dpi",
+    "~dev-libs/foo-1.2": "dev-libs/foo",
+    "dev-libs/foo:2/2.1": "dev-libs/foo",
+}
+
+# category/package/ebuild -> RDEPEND
+OVERLAY = {
+    "dev-libs/foo/foo-1.2.ebuild": "",
+    "dev-rust/serde/serde-1.0.100.ebuild": ">=dev-libs/foo-1.2:=",
+    "app-misc/rusty/rusty-1.ebuild": "dev-rust/serde",
+    "app-misc/usedep/usedep-1.ebuild": "dev-libs/foo[static-libs(+)]",
+    # blockers aren't dependencies
+    "app-misc/blocker/blocker-1.ebuild": "!dev-libs/foo !!<dev-rust/serde-2",
+    "media-fonts/font-adobe-100dpi/font-adobe-100dpi-1.0.ebuild": "app-misc/rusty",
+}
+
+# package -> everything depending on it, directly or not
+OVERLAY_CLOSURES = {
+    "dev-libs/foo": {
+        "dev-rust/serde",
+        "app-misc/rusty",
+        "app-misc/usedep",
+        "media-fonts/font-adobe-100dpi",
+    },
+    "dev-rust/serde": {"app-misc/rusty", "media-fonts/font-adobe-100dpi"},
+}
+
+
+def write_overlay(root, ebuilds):
+    """writes each ebuild in `ebuilds`, category/package/ebuild -> content"""
+    for path, content in ebuilds.items():
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fh:
+            fh.write(f"EAPI=7\n{content}\n")
+
+
+def check_index():
+    for atom, cp in CP_NAMES.items():
+        assert rpb.cp_name(atom) == cp, f"{atom}: {rpb.cp_name(atom)}, not {cp}"
+    with tempfile.TemporaryDirectory() as overlay:
+        write_overlay(
+            overlay,
+            {path: f'RDEPEND="{rdepend}"' for path, rdepend in OVERLAY.items()},
+        )
+        rpb.EBUILD_INDEX = rpb.EbuildIndex([overlay])
+        rpb.EBUILD_CACHE = None
+        rpb.JOBS = 1
+        graph = rpb.ReverseDependencyGraph()
+        for package, expected in OVERLAY_CLOSURES.items():
+            closure = set(graph.closure([package]))
+            assert closure == expected, f"{package}: {closure}, not {expected}"
+    print(f"reverse dependency index: {len(OVERLAY)} ebuilds ok")
+
+
+WHICH_OVERLAY = {
+    "dev-libs/foo/foo-1.0.ebuild": 'SLOT="0"',
+    "dev-libs/foo/foo-1.2-r1.ebuild": 'SLOT="0"',
+    "dev-libs/foo/foo-2.0.ebuild": 'SLOT="2/2.0"',
+    "dev-libs/foo/foo-9999.ebuild": 'SLOT="0"',
+    "dev-libs/bar/bar-3.ebuild": 'SLOT="0/${PV}"',
+}
+
+# atom -> the ebuild `EbuildIndex.which` finds, None if it can't resolve it
+WHICH = {
+    "dev-libs/foo": "foo-2.0",
+    "dev-libs/foo[ssl(+)]": "foo-2.0",
+    "<dev-libs/foo-1.2": "foo-1.0",
+    "<=dev-libs/foo-1.2": "foo-1.0",
+    "<=dev-libs/foo-1.2-r1": "foo-1.2-r1",
+    "<dev-libs/foo-1": None,
+    ">dev-libs/foo-1.2-r1": "foo-2.0",
+    ">=dev-libs/foo-2.1": "foo-9999",
+    "=dev-libs/foo-1.2": None,
+    "=dev-libs/foo-1.2-r1": "foo-1.2-r1",
+    "=dev-libs/foo-1*": "foo-1.2-r1",
+    "~dev-libs/foo-1.2": "foo-1.2-r1",
+    "dev-libs/foo:0": "foo-1.2-r1",
+    "dev-libs/foo:0=": "foo-1.2-r1",
+    "<dev-libs/foo-2:2": None,
+    "dev-libs/foo:2/2.0": "foo-2.0",
+    "dev-libs/foo:2/2.1": None,
+    "dev-libs/foo:*": "foo-2.0",
+    ">=dev-libs/foo": None,
+    # the slot is set from a variable, left to `equery which`
+    "dev-libs/bar:0": None,
+}
+
+
+def check_which():
+    with tempfile.TemporaryDirectory() as overlay:
+        write_overlay(overlay, WHICH_OVERLAY)
+        index = rpb.EbuildIndex([overlay])
+        for atom, expected in WHICH.items():
+            path = index.which(atom)
+            found = path and os.path.basename(path)[: -len(".ebuild")]
+            assert found == expected, f"{atom}: {found}, not {expected}"
+    print(f"EbuildIndex.which: {len(WHICH)} atoms ok")
+
+
+# ascending, per the package manager specification's version comparison
+VERSIONS = [
+    "not-a-version",
+    "1",
+    "1.0",
+    "1.0.1",
+    "1.1",
+    "1.1a",
+    "1.1b",
+    "1.2_alpha",
+    "1.2_alpha1",
+    "1.2_beta1",
+    "1.2_pre",
+    "1.2_rc1",
+    "1.2_rc1_p1",
+    "1.2_rc2",
+    "1.2",
+    "1.2-r1",
+    "1.2-r10",
+    "1.2_p1",
+    "1.2.0",
+    "1.10",
+    "2",
+    "9999",
+]
+
+
+def check_version_key():
+    for _ in range(20):
+        shuffled = random.sample(VERSIONS, len(VERSIONS))
+        ordered = sorted(shuffled, key=rpb.version_key)
+        assert ordered == VERSIONS, f"sorted as {ordered}"
+    print(f"version_key: {len(VERSIONS)} versions ok")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    check_minimal_cut(args.trials, args.seed)
+    check_lexer()
+    check_index()
+    check_which()
+    check_version_key()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,7 +9,12 @@ import yaml
 import datetime
 import subprocess
 import pprint
+import json
+import hashlib
+import sqlite3
+import tempfile
 import jinja2
+from concurrent.futures import ProcessPoolExecutor
 from string import Template
 from functools import partial
 from typing import List, Optional, Sequence, Union
@@ -26,17 +31,41 @@ CHROMIUMOS_OVERLAY = (
 PORTAGE_STABLE = "/home/chrome/chromiumos/src/third_party/portage-stable"
 # profile directory
 CHROMEOS_TARGET_PROFILES_ROOT = f"{CHROMIUMOS_OVERLAY}/profiles/target/chromeos"
+# persistent cache of parsed ebuilds and `equery which` lookups
+CACHE_PATH = os.path.expanduser(
+    "~/.cache/remove_package_from_build/ebuilds.sqlite"
+)
 # controls debug logging
 DEBUG = False
+# if True, the cache is cleared before running
 CLEAN = False
+# number of processes parsing ebuilds, 1 parses in process
+JOBS = os.cpu_count() or 1
 # each entry to modified/failed is
 # {"package": "net-libs/etc", "path": "full/path/to/ebuild"}
 # if modified, add "use_flag": "flag"
+OUTPUT = {"modified": [], "failed": []}
+# answers the decisions of batch mode (--policy), a policy file overrides
+# some or all of these
+#   no_reverse_dependencies: a non-toggleable dependent that nothing else
+#     depends on is masked ("mask") or reported ("report")
+#   toggleable: a dependent that can drop the dependency by disabling a use
+#     flag has the flag masked ("use_mask") or is reported ("report")
+#   extend_use_mask: if a dependent already has a package.use.mask entry,
+#     add the flag to it (true) or report it (false)
+#   exclude: dependents that are always reported, never masked
+DEFAULT_POLICY = {
+    "no_reverse_dependencies": "mask",
+    "toggleable": "use_mask",
+    "extend_use_mask": True,
+    "exclude": [],
+}
+POLICY_CHOICES = {
+    "no_reverse_dependencies": ("mask", "report"),
+    "toggleable": ("use_mask", "report"),
+}
 # patterns for parsing the ebuild
 patterns = {}
-patterns["start_declaration"] = re.compile('[\w\d\-\_]+\+?="')
-patterns["start_quote"] = re.compile('"\s*')
-patterns["end_quote"] = re.compile(r'.*"')
 patterns["depend"] = re.compile('\w*?DEPEND\+?="')
 patterns["atom"] = re.compile("^[^\s]+\/[^\s]+$")
 patterns["flag"] = re.compile("^(\!|\+|\-)?[A-Za-z0-9\-_]+\??$")
@@ -44,11 +73,32 @@ patterns["use"] = re.compile("(I|COMMON_)?USE\+?=")
 patterns["toggleable_flag"] = re.compile("[\w\d\-_]+\?")
 patterns["var"] = re.compile("\$\{[\w\d\-\._]+\}")
 patterns["package"] = re.compile("((>=)?[\w\d\.\-]+\/?[\w\d\.-]+(:=)?)")
-patterns["comment"] = re.compile("#.*?$")
 patterns["virtual"] = re.compile("virtual\/.+")
 patterns["inclusive_or"] = re.compile(re.escape("||"))
 patterns["exclusive_or"] = re.compile(re.escape("^^"))
 patterns["at_most"] = re.compile(re.escape("??"))
+# the lexer's two states: between declarations, where comments, other
+# strings and shell code are skipped, and inside a declaration's value
+patterns["lex_outside"] = re.compile(
+    r"""
+    (?P<declaration>(?<![\w$])(?P<name>[A-Za-z_]\w*)(?P<append>\+?)=")
+    |(?P<comment>\#[^\n]*)
+    |(?P<string>"(?:[^"\\]|\\.)*"|'[^']*')
+    |(?P<skip>\w+|[^\w#"']+|.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+patterns["lex_value"] = re.compile(
+    r"""
+    (?P<space>(?:\s|\\\n)+)
+    |(?P<end>")
+    |(?P<paren>[()])
+    |(?P<operator>\|\||\^\^|\?\?)(?=[\s"])
+    |(?P<conditional>!?[\w+\-.@]+\?)(?=[\s"])
+    |(?P<token>(?:[^\s()"\[]+|\[[^\]\s"]*\]?)+)
+    """,
+    re.VERBOSE,
+)
 
 patterns["atom_modifiers"] = {}
 patterns["atom_modifiers"]["version"]=re.compile("([\-](\d{1,3})\.?(\d{1,3})?\.?(\d{1,3})?\*?)")
@@ -84,6 +134,35 @@ The following packages cannot be removed automatically:
 """
 )
 
+batch_report = jinja2.Template(
+    """
+attempting to remove:
+{% for p in packages %}
+  - {{ p }}
+{% endfor %}
+{% if closure is defined %}
+
+{{ closure | length }} packages depend on these, directly or not
+{% endif %}
+
+The following atoms will be added to `package.mask`
+{% for p in package_masks %}
+  - {{ p }}
+{% endfor %}
+
+The following atoms will be added to `package.use.mask`
+{% for p, flag in package_use_masks %}
+  - {{ p }} {{ flag }}
+{% endfor %}
+
+The following packages cannot be removed automatically:
+{% for p, blocking in nonoptional_dependencies.items() %}
+  - {{ p }} (depends on {{ blocking | join(", ") }})
+{% endfor %}
+
+"""
+)
+
 
 def zprint(s: str, debug: bool = False):
     if all([DEBUG, debug]):
@@ -96,11 +175,77 @@ def get_parser() -> commandline.ArgumentParser:
     """Build the argument parser."""
     parser = commandline.ArgumentParser(description=__doc__)
 
-    parser.add_argument("-p", "--package", help="Package.", required=True)
+    parser.add_argument(
+        "-p",
+        "--package",
+        action="append",
+        help="Package, can be repeated.",
+        default=[],
+    )
+    parser.add_argument(
+        "--package-list",
+        type="path",
+        help="a file of packages to remove, one per line",
+    )
+    parser.add_argument(
+        "--policy",
+        type="path",
+        help="run non-interactively, answering decisions with this policy "
+        "(yaml) file",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="with --policy or --transitive, only report the plan",
+        default=False,
+    )
+    parser.add_argument(
+        "--plan",
+        type="path",
+        help="with --policy or --transitive, write the plan as json here",
+    )
+    parser.add_argument(
+        "--transitive",
+        action="store_true",
+        help="plan the fewest masks removing every transitive reverse "
+        "dependency, rather than looking one level up",
+        default=False,
+    )
+    parser.add_argument(
+        "--use",
+        help="with --transitive, the use flags assumed, e.g. "
+        "\"cups -ssl net-print/cups:-ssl\"",
+        default="",
+    )
     parser.add_argument(
         "--vbose", action="store_true", help="debug logging", default=False
     )
     parser.add_argument("--sysroot", type="path", help="Sysroot path.")
+    parser.add_argument(
+        "--overlay",
+        action="append",
+        type="path",
+        help="an additional overlay to index, takes priority over the defaults",
+        default=[],
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't read or write the ebuild cache",
+        default=False,
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="clear the ebuild cache before running",
+        default=False,
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="number of processes parsing ebuilds",
+        default=JOBS,
+    )
     return parser
 
 
@@ -141,7 +286,7 @@ def prompt_yn(prompt):
 
 def prompt_selection(selections):
     num=len(selections)
-    while True
+    while True:
         print("Choose one of the following")
         for i,s in enumerate(selections):
             print(f"{i+1}. {s}")
@@ -151,94 +296,967 @@ def prompt_selection(selections):
         else:
             print("Invalid selection")
 
-def get_temporary_filehandle(file_):
-    fullpath_ = os.path.abspath(file_)
-    path_, f_ = os.path.split(fullpath_)
-    temp = f"~{f_}"
-    return (fullpath_, f"{path_}/{temp}")
+def read_content(filepath):
+    content = ""
+    with open(filepath, "r") as fh:
+        content += fh.read()
+    return content
+
+
+
+class EbuildCache:
+    """
+    a persistent (sqlite) cache of parsed ebuilds and `equery which` results
+
+    parsed ebuilds are keyed by path, and are valid while the file's mtime and
+    size are unchanged. if only the mtime changed (e.g. a git checkout), the
+    content hash decides, so touched files don't need to be parsed again
+
+    `equery which` results are valid while the package directory, which
+    changes when an ebuild is added or removed, has the same mtime
+
+    `version` is bumped whenever the parser changes, parsed ebuilds from
+    another version are discarded
+    """
+
+    version = 6
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS ebuilds (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER,
+            size INTEGER,
+            hash TEXT,
+            parsed TEXT
+        );
+        CREATE TABLE IF NOT EXISTS which (
+            atom TEXT PRIMARY KEY,
+            path TEXT,
+            dir_mtime_ns INTEGER
+        );
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared with forked processes,
+        # so each process opens its own
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.executescript(self.schema)
+            self._pid = os.getpid()
+            (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+            if version != self.version:
+                self._clear_parsed()
+                with self._conn:
+                    self._conn.execute(f"PRAGMA user_version = {self.version}")
+        return self._conn
+
+    @staticmethod
+    def _hash(filepath):
+        with open(filepath, "rb") as fh:
+            return hashlib.sha1(fh.read()).hexdigest()
+
+    def get(self, filepath):
+        """
+        returns the parsed content of the ebuild at `filepath`, as stored by
+        `put`, or None if it's not cached or the file has changed
+        """
+        row = self.conn.execute(
+            "SELECT mtime_ns, size, hash, parsed FROM ebuilds WHERE path = ?",
+            (filepath,),
+        ).fetchone()
+        if not row:
+            return None
+        mtime_ns, size, hash_, parsed = row
+        st = os.stat(filepath)
+        if st.st_size != size:
+            return None
+        if st.st_mtime_ns != mtime_ns:
+            if self._hash(filepath) != hash_:
+                return None
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE ebuilds SET mtime_ns = ? WHERE path = ?",
+                    (st.st_mtime_ns, filepath),
+                )
+        zprint(f"ebuild cache hit: {filepath}", debug=True)
+        return json.loads(parsed)
+
+    def put(self, filepath, parsed):
+        st = os.stat(filepath)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO ebuilds VALUES (?, ?, ?, ?, ?)",
+                (
+                    filepath,
+                    st.st_mtime_ns,
+                    st.st_size,
+                    self._hash(filepath),
+                    json.dumps(parsed),
+                ),
+            )
+
+    def which(self, atom):
+        """returns the cached ebuild path for `atom`, or None"""
+        row = self.conn.execute(
+            "SELECT path, dir_mtime_ns FROM which WHERE atom = ?", (atom,)
+        ).fetchone()
+        if not row:
+            return None
+        path, dir_mtime_ns = row
+        try:
+            if os.stat(os.path.dirname(path)).st_mtime_ns != dir_mtime_ns:
+                return None
+        except OSError:
+            return None
+        return path
+
+    def put_which(self, atom, path):
+        dir_mtime_ns = os.stat(os.path.dirname(path)).st_mtime_ns
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO which VALUES (?, ?, ?)",
+                (atom, path, dir_mtime_ns),
+            )
+
+    def _clear_parsed(self):
+        # the reverse dependency index is built from the parsed ebuilds
+        with self._conn:
+            self._conn.execute("DELETE FROM ebuilds")
+            self._conn.execute("DROP TABLE IF EXISTS revdeps")
+            self._conn.execute("DROP TABLE IF EXISTS revdep_sources")
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM which")
+        self._clear_parsed()
+
+
+# set to None (--no-cache) to disable caching
+EBUILD_CACHE = EbuildCache()
+
+# portage version suffixes, in order. a version without a suffix sorts
+# between _rc and _p
+VERSION_SUFFIXES = {"alpha": 0, "beta": 1, "pre": 2, "rc": 3, "": 4, "p": 5}
+patterns["version"] = re.compile(
+    r"^(\d+(?:\.\d+)*)([a-z])?((?:_(?:alpha|beta|pre|rc|p)\d*)*)(?:-r(\d+))?$"
+)
+patterns["version_suffix"] = re.compile(r"_(alpha|beta|pre|rc|p)(\d*)")
+patterns["cpv"] = re.compile(r"^(.+?)-(\d[^-]*(?:-r\d+)?)$")
+patterns["which"] = re.compile(
+    r"^(?P<op>[<>]=?|=|~)?(?P<cpv>[^:\[*\s]+)(?P<glob>\*)?(?::(?P<slot>[^\[\s]*))?(?:\[.*\])?$"
+)
+patterns["cp"] = re.compile(r"^[!~<>=]*([^\[:]+?)\*?(?:[:\[].*)?$")
+
+
+def cp_name(atom):
+    """
+    the category/package of an atom, e.g. dev-libs/foo for
+    >=dev-libs/foo-1.2-r1:0=[ssl(+)]
+
+    unlike `get_atom_name`, which strips anything that looks like a version
+    or revision (dev-rust/serde -> dev/serde), only a trailing version is
+    removed, so media-fonts/font-adobe-100dpi is kept as it is
+    """
+    m = patterns["cp"].match(atom.strip())
+    if not m:
+        return atom
+    cp = m.group(1)
+    m = patterns["cpv"].match(cp)
+    if m and patterns["version"].match(m.group(2)):
+        return m.group(1)
+    return cp
+
+
+def version_key(version):
+    """
+    a sort key for a portage version string, e.g. 1.2.3a_rc1-r2
+
+    unparseable versions sort before everything else, live (9999) versions
+    after everything else
+    """
+    m = patterns["version"].match(version)
+    if not m:
+        return (0, (), "", (), 0)
+    numbers, letter, suffixes, revision = m.groups()
+    suffixes = [
+        (VERSION_SUFFIXES[name], int(n or 0))
+        for name, n in patterns["version_suffix"].findall(suffixes or "")
+    ]
+    suffixes.append((VERSION_SUFFIXES[""], 0))
+    live = 2 if numbers.split(".")[0] == "9999" else 1
+    return (
+        live,
+        tuple(int(x) for x in numbers.split(".")),
+        letter or "",
+        tuple(suffixes),
+        int(revision or 0),
+    )
+
+
+class EbuildIndex:
+    """
+    an in process replacement for `equery which`
+
+    the overlays are scanned once, on first use, into a map of
+    category/package -> [(version, path)], best first. the best ebuild is
+    the highest non live version, with earlier overlays winning a tie, or
+    the live ebuild if that's all there is. keywords and masks aren't
+    considered, atoms that aren't found fall back to `equery which`
+    """
+
+    skip = {"eclass", "licenses", "metadata", "profiles", "scripts"}
+
+    def __init__(self, overlays=(CHROMIUMOS_OVERLAY, PORTAGE_STABLE)):
+        self.overlays = list(overlays)
+        self._index = None
+        self._slots = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self._scan()
+        return self._index
+
+    def _scan(self):
+        index = {}
+        for priority, overlay in enumerate(self.overlays):
+            if not os.path.isdir(overlay):
+                zprint(f"overlay not found: {overlay}", debug=True)
+                continue
+            for category in os.scandir(overlay):
+                if (
+                    not category.is_dir()
+                    or category.name in self.skip
+                    or category.name.startswith(".")
+                ):
+                    continue
+                for package in os.scandir(category.path):
+                    if not package.is_dir():
+                        continue
+                    prefix = f"{package.name}-"
+                    for f in os.scandir(package.path):
+                        if not (
+                            f.name.endswith(".ebuild")
+                            and f.name.startswith(prefix)
+                        ):
+                            continue
+                        version = f.name[len(prefix) : -len(".ebuild")]
+                        index.setdefault(
+                            f"{category.name}/{package.name}", []
+                        ).append((version, priority, f.path))
+        for cp, ebuilds in index.items():
+            # best first: highest version, then the highest priority overlay,
+            # with live ebuilds last
+            keyed = sorted(
+                ((version_key(v), -priority, v, path) for v, priority, path in ebuilds),
+                reverse=True,
+            )
+            index[cp] = [(v, path) for k, _, v, path in keyed if k[0] != 2] + [
+                (v, path) for k, _, v, path in keyed if k[0] == 2
+            ]
+        zprint(f"indexed {len(index)} packages", debug=True)
+        return index
 
+    def which(self, atom):
+        """
+        returns the path of the best ebuild matching `atom`, or None
 
-def make_temporary_file(file_):
-    orig, temp = get_temporary_filehandle(file_)
-    with open(orig, "rb") as existing:
-        with open(temp, "wb") as new:
-            new.write(existing.read())
+        `atom` can be a category/package, or a versioned atom with any of the
+        operators = ~ < <= > >= (and =cat/pkg-1.2*), and a slot, e.g.
+        >=cat/pkg-1.2:0=. None is also returned when a candidate's SLOT
+        can't be read from its ebuild (e.g. it's set by an eclass), so that
+        `equery which` decides instead
+        """
+        m = patterns["which"].match(atom.strip())
+        if not m:
+            return None
+        op, cp, glob, slot = m.group("op", "cpv", "glob", "slot")
+        version = None
+        if cp not in self.index:
+            m = patterns["cpv"].match(cp)
+            if not m or not patterns["version"].match(m.group(2)):
+                return None
+            cp, version = m.groups()
+            # a version without an operator is taken as an exact version
+            op = op or "="
+        elif op:
+            return None
+        ebuilds = self.index.get(cp)
+        if not ebuilds:
+            return None
+        slot = (slot or "").rstrip("=")
+        for v, path in ebuilds:
+            if version and not self._version_matches(v, op, version, glob):
+                continue
+            if slot and slot != "*":
+                ebuild_slot = self._slot(path)
+                if ebuild_slot is None:
+                    return None
+                if "/" not in slot:
+                    ebuild_slot = ebuild_slot.split("/")[0]
+                if ebuild_slot != slot:
+                    continue
+            # ebuilds are best first
+            return path
+        return None
 
+    @staticmethod
+    def _version_matches(v, op, version, glob=False):
+        if op == "~":
+            return re.sub(r"-r\d+$", "", v) == re.sub(r"-r\d+$", "", version)
+        if glob:
+            return op == "=" and v.startswith(version)
+        key, other = version_key(v), version_key(version)
+        return {
+            "=": key == other,
+            "<": key < other,
+            "<=": key <= other,
+            ">": key > other,
+            ">=": key >= other,
+        }[op]
+
+    def _slot(self, path):
+        """the SLOT of the ebuild at `path`, or None if it can't be read"""
+        if path not in self._slots:
+            slot = None
+            events = lex_ebuild(read_content(path))
+            for kind, value in events:
+                if kind == "declaration" and value == ("SLOT", False):
+                    slot = Package._skip_declaration(events).strip()
+            if slot and "$" in slot:
+                slot = None
+            self._slots[path] = slot
+        return self._slots[path]
+
+    def packages(self):
+        """all indexed category/package names"""
+        return self.index.keys()
+
+
+EBUILD_INDEX = EbuildIndex()
+
+
+def _init_parse_worker(index, cache_path, debug):
+    global DEBUG, EBUILD_CACHE, EBUILD_INDEX
+    DEBUG = debug
+    EBUILD_INDEX = index
+    EBUILD_CACHE = EbuildCache(cache_path) if cache_path else None
+
+
+def _parse_package(name, filepath=None):
+    """
+    parses the ebuild of `name`, at `filepath` if it's already known, in a
+    worker process
 
-def write_temporary_file(file_):
-    orig, temp = get_temporary_filehandle(file_)
-    if not os.path.exists(temp):
-        raise Exception(f"no temporary file for {orig} available")
+    Returns:
+        (name, filepath, parsed), parsed is the package's `to_dict`, or None
+        if there's no ebuild or it failed to parse
+    """
     try:
-        with open(temp, "rb") as new:
-            with open(orig, "wb") as existing:
-                existing.write(new.read())
-        os.remove(temp)
-    except:
-        raise
+        package = Package(name, parse_ebuild=True, filepath=filepath)
+    except Exception as e:
+        zprint(f"failed to parse {name}: {e}", debug=True)
+        return name, None, None
+    if not package.filepath:
+        return name, None, None
+    return name, package.filepath, package.to_dict()
 
 
-def read_content(filepath):
-    content = ""
-    with open(filepath, "r") as fh:
-        content += fh.read()
-    return content
+def parse_packages(names, jobs=None, filepaths=None):
+    """
+    parses the ebuilds of `names` across a pool of `jobs` processes,
+    `filepaths` maps names to their ebuilds where they're already known,
+    e.g. from `EBUILD_INDEX`, the rest are looked up
 
+    only plain data (`Package.to_dict`) comes back from the workers, parsed
+    ebuilds are also written to the cache by the worker that parsed them
 
+    Yields:
+        (name, filepath, parsed) in the order of `names`
+    """
+    names = list(dict.fromkeys(names))
+    filepaths = [(filepaths or {}).get(name) for name in names]
+    jobs = min(jobs or JOBS, len(names))
+    if jobs <= 1:
+        yield from map(_parse_package, names, filepaths)
+        return
+    # scan the overlays once, the workers get a copy of the index
+    EBUILD_INDEX.index
+    initargs = (EBUILD_INDEX, EBUILD_CACHE.path if EBUILD_CACHE else None, DEBUG)
+    with ProcessPoolExecutor(
+        jobs, initializer=_init_parse_worker, initargs=initargs
+    ) as pool:
+        chunksize = max(1, len(names) // (jobs * 4))
+        yield from pool.map(_parse_package, names, filepaths, chunksize=chunksize)
 
-def tokenize(string):
-    tokens = string.replace("\n", "").replace('"', " ").split(" ")
-    tokens = [x for x in tokens if x != ""]
-    return tokens
 
+class ReverseDependencyIndex:
+    """
+    a whole tree replacement for `equery depends -a`
+
+    the best ebuild of every package in `EBUILD_INDEX` is parsed once, and
+    each dependency becomes an edge target <- (dependent, useflag), where
+    useflag names the conditional guarding the dependency (`cups?` -> cups,
+    `!cups?` -> !cups), or None if it's unconditional
+
+    with the ebuild cache enabled the edges are stored alongside it, and
+    `update` only parses ebuilds that were added or changed since the last
+    run, and drops the edges of ebuilds that were removed
+    """
 
-def add_package_mask(package, version=""):
+    schema = """
+        CREATE TABLE IF NOT EXISTS revdep_sources (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER,
+            size INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS revdeps (
+            target TEXT,
+            dependent TEXT,
+            useflag TEXT,
+            path TEXT
+        );
+        CREATE INDEX IF NOT EXISTS revdeps_path ON revdeps (path);
     """
-    adds an entry to the package.mask file at chromiumos-overlay/profiles/target/chromeos/
+
+    def __init__(self):
+        self._rdeps = None
+
+    @staticmethod
+    def _edges(cp, parsed):
+        """the (target, dependent, useflag) edges declared by `cp`"""
+        if not parsed:
+            return []
+        return [
+            (cp_name(name), cp, flag)
+            for name, flag in parsed["dependencies"]
+        ]
+
+    def update(self):
+        """parses new or changed ebuilds, then loads the graph into memory"""
+        current = {}
+        for cp in EBUILD_INDEX.packages():
+            path = EBUILD_INDEX.which(cp)
+            st = os.stat(path)
+            current[path] = (cp, st.st_mtime_ns, st.st_size)
+        if not EBUILD_CACHE:
+            paths = {cp: path for path, (cp, _, _) in current.items()}
+            edges = [
+                e
+                for cp, _, parsed in parse_packages(paths, filepaths=paths)
+                for e in self._edges(cp, parsed)
+            ]
+            self._load(edges)
+            return
+        conn = EBUILD_CACHE.conn
+        conn.executescript(self.schema)
+        stored = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in conn.execute("SELECT * FROM revdep_sources")
+        }
+        stale = [p for p in stored if stored[p] != current.get(p, (None,))[1:]]
+        changed = [p for p in current if stored.get(p) != current[p][1:]]
+        zprint(
+            f"reverse dependency index: {len(changed)} ebuilds to parse, "
+            f"{len(set(stale) - set(changed))} removed",
+            debug=True,
+        )
+        with conn:
+            conn.executemany(
+                "DELETE FROM revdeps WHERE path = ?", [(p,) for p in stale]
+            )
+            conn.executemany(
+                "DELETE FROM revdep_sources WHERE path = ?", [(p,) for p in stale]
+            )
+        paths = {current[path][0]: path for path in changed}
+        for cp, _, parsed in parse_packages(paths, filepaths=paths):
+            path = paths[cp]
+            _, mtime_ns, size = current[path]
+            edges = self._edges(cp, parsed)
+            # commit per ebuild, so an interrupted run keeps its progress
+            with conn:
+                conn.executemany(
+                    "INSERT INTO revdeps VALUES (?, ?, ?, ?)",
+                    [e + (path,) for e in edges],
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO revdep_sources VALUES (?, ?, ?)",
+                    (path, mtime_ns, size),
+                )
+        self._load(conn.execute("SELECT target, dependent, useflag FROM revdeps"))
+
+    def _load(self, edges):
+        rdeps = {}
+        for target, dependent, useflag in edges:
+            rdeps.setdefault(target, []).append((dependent, useflag))
+        self._rdeps = rdeps
+
+    def rdepends(self, package):
+        """
+        the packages depending on `package`
+
+        Returns:
+            a list of (dependent, useflag), useflag is None if the dependency
+            isn't conditional
+        """
+        return self.graph.get(cp_name(package), [])
+
+    @property
+    def graph(self):
+        """the whole index, a dict of package -> `rdepends`"""
+        if self._rdeps is None:
+            self.update()
+        return self._rdeps
+
+
+REVDEP_INDEX = ReverseDependencyIndex()
+
+
+def reverse_dependencies(package):
+    """
+    like `equery_depends`, but answered from `REVDEP_INDEX`
+
+    Returns:
+        a dict of dependent -> the name of the useflag guarding its
+        dependency on `package`, or None if any of its dependencies on
+        `package` is unconditional. a name starting with ! is a `!flag?`
+        conditional, which masking the flag can't drop
+    """
+    deps = {}
+    for dependent, useflag in REVDEP_INDEX.rdepends(package):
+        if dependent == cp_name(package):
+            continue
+        if dependent in deps and (deps[dependent] is None or useflag is None):
+            deps[dependent] = None
+        else:
+            deps.setdefault(dependent, useflag)
+    return deps
+
+
+def parse_use(use):
+    """
+    parses a use flag assignment, like USE: "cups -ssl" enables cups and
+    disables ssl everywhere, "net-print/cups:-ssl" only for net-print/cups
+
+    Returns:
+        a dict of flag or package:flag -> enabled
+    """
+    assignment = {}
+    for token in (use or "").split():
+        package, _, flag = token.rpartition(":")
+        enabled = not flag.startswith("-")
+        flag = flag.lstrip("+-")
+        assignment[f"{package}:{flag}" if package else flag] = enabled
+    return assignment
+
+
+class _FlowNetwork:
+    """a flow network for `minimal_cut`, max flow is found with dinic's algorithm"""
+
+    def __init__(self):
+        # edge e goes to `to[e]`, its reverse edge is e ^ 1
+        self.to = []
+        self.cap = []
+        self.adj = []
+
+    def add_node(self):
+        self.adj.append([])
+        return len(self.adj) - 1
+
+    def add_edge(self, u, v, cap):
+        self.adj[u].append(len(self.to))
+        self.to.append(v)
+        self.cap.append(cap)
+        self.adj[v].append(len(self.to))
+        self.to.append(u)
+        self.cap.append(0)
+
+    def _levels(self, s):
+        level = [-1] * len(self.adj)
+        level[s] = 0
+        queue = [s]
+        for u in queue:
+            for e in self.adj[u]:
+                v = self.to[e]
+                if self.cap[e] > 0 and level[v] < 0:
+                    level[v] = level[u] + 1
+                    queue.append(v)
+        return level
+
+    def min_cut(self, s, t):
+        """
+        Returns:
+            the nodes on the source side of a minimum s-t cut
+        """
+        to, cap, adj = self.to, self.cap, self.adj
+        while True:
+            level = self._levels(s)
+            if level[t] < 0:
+                return {u for u, l in enumerate(level) if l >= 0}
+            it = [0] * len(adj)
+            # find augmenting paths in the level graph, iteratively as the
+            # paths can be longer than the recursion limit
+            path = []
+            u = s
+            while True:
+                if u == t:
+                    f = min(cap[e] for e in path)
+                    for e in path:
+                        cap[e] -= f
+                        cap[e ^ 1] += f
+                    path = []
+                    u = s
+                    continue
+                edges = adj[u]
+                while it[u] < len(edges):
+                    e = edges[it[u]]
+                    if cap[e] > 0 and level[to[e]] == level[u] + 1:
+                        break
+                    it[u] += 1
+                else:
+                    # a dead end, retreat
+                    if u == s:
+                        break
+                    level[u] = -1
+                    u = to[path.pop() ^ 1]
+                    it[u] += 1
+                    continue
+                path.append(e)
+                u = to[e]
+
+
+class ReverseDependencyGraph:
+    """
+    transitive reverse dependencies over `REVDEP_INDEX`, under a use flag
+    assignment (see `parse_use`)
+
+    a dependency guarded by `flag?` exists unless the flag is disabled, and
+    can be cut by masking the flag for the dependent. one guarded by
+    `!flag?` exists unless the flag is enabled, and can't be cut by a mask.
+    flags that aren't assigned are assumed to be in their worst state, i.e.
+    the dependency exists
+    """
+
+    def __init__(self, assignment=None, index=None):
+        self.assignment = assignment or {}
+        self.index = index or REVDEP_INDEX
+
+    def _flag(self, package, flag):
+        """whether `flag` is enabled for `package`, None if it's not assigned"""
+        enabled = self.assignment.get(f"{package}:{flag}")
+        if enabled is None:
+            enabled = self.assignment.get(flag)
+        return enabled
+
+    def edges(self, package):
+        """
+        the dependencies on `package` that exist under the assignment
+
+        Returns:
+            a list of (dependent, useflag), useflag is the flag that can be
+            masked to drop the dependency, or None if it can't be
+        """
+        edges = []
+        for dependent, flag in self.index.graph.get(package, ()):
+            if dependent == package:
+                continue
+            if flag and flag.startswith("!"):
+                if self._flag(dependent, flag[1:]) is True:
+                    continue
+                flag = None
+            elif flag and self._flag(dependent, flag) is False:
+                continue
+            edges.append((dependent, flag))
+        return edges
+
+    def closure(self, packages):
+        """
+        everything that depends on `packages`, directly or not
+
+        Returns:
+            a dict of dependent -> the package it was reached from, in
+            breadth first order
+        """
+        packages = [cp_name(p) for p in packages]
+        reached = dict.fromkeys(packages)
+        queue = list(packages)
+        for package in queue:
+            for dependent, _ in self.edges(package):
+                if dependent not in reached:
+                    reached[dependent] = package
+                    queue.append(dependent)
+        for package in packages:
+            del reached[package]
+        return reached
+
+    def minimal_cut(self, packages, policy=None, mask_cost=None, use_mask_cost=1):
+        """
+        the cheapest package.mask and package.use.mask edits that leave
+        nothing depending on `packages`
+
+        a masked package takes everything depending on it with it, so its
+        dependents have to be masked or cut as well. with the default
+        `mask_cost`, package masks are minimized first, then use masks
+
+        `policy` (see `DEFAULT_POLICY`) restricts the edits: excluded
+        packages, or any package if no_reverse_dependencies is "report",
+        are never masked, and no flag is masked if toggleable is "report".
+        a package that can't be masked but can't be cut off either is
+        reported, and what depends on it is left out of the plan
+
+        this is solved as a minimum cut: the source side holds what's
+        removed, a dependency t <- d is an infinite edge t -> d, or if it's
+        guarded by a flag f, an infinite edge t -> (d, f) and an edge
+        (d, f) -> d costing a use mask. every package has an edge to the
+        sink costing a package mask, infinite if it can't be masked
+
+        Returns:
+            the plan, in the format of `plan_removal`, with the closure
+            under "closure"
+        """
+        policy = policy or DEFAULT_POLICY
+        exclude = {cp_name(p) for p in policy["exclude"]}
+        can_mask = policy["no_reverse_dependencies"] == "mask"
+        packages = list(dict.fromkeys(cp_name(p) for p in packages))
+        closure = self.closure(packages)
+        edges = {p: self.edges(p) for p in packages + list(closure)}
+        if policy["toggleable"] != "use_mask":
+            edges = {p: [(d, None) for d, _ in es] for p, es in edges.items()}
+
+        # packages that can't be masked, but depend on `packages` through
+        # dependencies that can't be cut
+        reported = {}
+        forced = dict.fromkeys(packages)
+        queue = list(packages)
+        for p in queue:
+            for d, f in edges[p]:
+                if f or d in forced:
+                    continue
+                if d in exclude or not can_mask:
+                    blocking = reported.setdefault(d, [])
+                    if p not in blocking:
+                        blocking.append(p)
+                    continue
+                forced[d] = None
+                queue.append(d)
+        for p in reported:
+            del edges[p]
+        edges = {
+            p: [(d, f) for d, f in es if d not in reported]
+            for p, es in edges.items()
+        }
+
+        flags = {(d, f) for es in edges.values() for d, f in es if f}
+        if mask_cost is None:
+            mask_cost = use_mask_cost * len(flags) + 1
+        net = _FlowNetwork()
+        source, sink = net.add_node(), net.add_node()
+        node = {p: net.add_node() for p in edges}
+        flag_node = {k: net.add_node() for k in flags}
+        for p in packages:
+            net.add_edge(source, node[p], float("inf"))
+        for p in closure:
+            if p in node:
+                cost = mask_cost if can_mask and p not in exclude else float("inf")
+                net.add_edge(node[p], sink, cost)
+        for k, n in flag_node.items():
+            net.add_edge(n, node[k[0]], use_mask_cost)
+        for target, es in edges.items():
+            for d, f in es:
+                head = flag_node[(d, f)] if f else node[d]
+                net.add_edge(node[target], head, float("inf"))
+        removed = net.min_cut(source, sink)
+        return {
+            "packages": packages,
+            "closure": list(closure),
+            "package_masks": [
+                p for p in closure if p in node and node[p] in removed
+            ],
+            "package_use_masks": sorted(
+                k
+                for k, n in flag_node.items()
+                if n in removed and node[k[0]] not in removed
+            ),
+            "nonoptional_dependencies": reported,
+        }
+
+def lex_ebuild(content):
+    """
+    a single pass lexer over the content of an ebuild
+
+    Yields:
+        (kind, value) events, for each NAME="value" or NAME+="value"
+          ("declaration", (NAME, append))
+          then for each part of the value, one of
+            ("paren", "(" or ")")
+            ("operator", "||", "^^" or "??")
+            ("conditional", e.g. "cups?" or "!cups?")
+            ("token", e.g. ">=dev-libs/foo-1.2:=" or "+ssl"), a token keeps
+              its use dependencies, e.g. "dev-libs/foo[static-libs(+)]"
+          ("end", value), the raw value without quotes
+        a declaration that's never closed ends at the end of the content
+    """
+    outside = patterns["lex_outside"].match
+    value = patterns["lex_value"].match
+    pos = 0
+    n = len(content)
+    while pos < n:
+        m = outside(content, pos)
+        pos = m.end()
+        if m.lastgroup != "declaration":
+            continue
+        yield "declaration", (m.group("name"), bool(m.group("append")))
+        start = pos
+        kind = None
+        while pos < n:
+            m = value(content, pos)
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == "end":
+                break
+            if kind != "space":
+                yield kind, m.group(kind)
+        yield "end", content[start : pos - 1 if kind == "end" else pos]
+
+
+class MaskFile:
+    """
+    an in memory package.mask or package.use.mask
+
+    the file is read once and its entries are indexed by atom, edits are
+    made in memory and `write` replaces the file in one go, via a temporary
+    file that's fsync'd and renamed over it, so it's never partially written
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = []
+        # atom -> index of the first line with an entry for it
+        self.index = {}
+        self.modified = False
+        if os.path.exists(path):
+            self.lines = read_content(path).splitlines()
+        for i, line in enumerate(self.lines):
+            self._index(i)
+
+    def _index(self, i):
+        entry = self.lines[i].split("#", 1)[0].split()
+        if entry:
+            self.index.setdefault(cp_name(entry[0]), i)
+
+    def append(self, line):
+        self.lines.append(line)
+        self._index(len(self.lines) - 1)
+        self.modified = True
+
+    def get(self, package):
+        """the entry for `package` split into tokens, or None"""
+        i = self.index.get(cp_name(package))
+        if i is None:
+            return None
+        return self.lines[i].split("#", 1)[0].split()
+
+    def add_flag(self, package, use_flag):
+        """adds `use_flag` to the existing entry for `package`"""
+        i = self.index[cp_name(package)]
+        entry, sep, comment = self.lines[i].partition("#")
+        self.lines[i] = f"{entry.rstrip()} {use_flag}"
+        if sep:
+            self.lines[i] += f" {sep}{comment}"
+        self.modified = True
+
+    def write(self):
+        if not self.modified:
+            return
+        path = os.path.abspath(self.path)
+        directory = os.path.dirname(path)
+        fd, temp = tempfile.mkstemp(
+            prefix=f"~{os.path.basename(path)}.", dir=directory
+        )
+        try:
+            with os.fdopen(fd, "w") as fh:
+                fh.write("\n".join(self.lines) + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+            if os.path.exists(path):
+                mode = os.stat(path).st_mode & 0o7777
+            else:
+                # mkstemp creates the file 0600, give a new file the mode
+                # open() would have
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o644 & ~umask
+            os.chmod(temp, mode)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        # make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.modified = False
+
+
+def add_package_mask(mask_file, package, version=""):
+    """
+    adds an entry for `package` to `mask_file`, the package.mask file at
+    chromiumos-overlay/profiles/target/chromeos/
     """
-    global CHROMEOS_TARGET_PROFILES_ROOT, OUTPUT
-    fh = f"{CHROMEOS_TARGET_PROFILES_ROOT}/~package.mask"
     # check to see if the package is already masked
-    cmd = "cat ${fh} | grep {package}"
-    res = run_subprocess(cmd)
-    if res:
+    if mask_file.get(package):
         zprint(
             f"not adding the package: {package} to package.mask,  it already exists",
             debug=True,
         )
         return
-    else:
-        package_string = ""
-        package_string += f"{package}"
-        if version:
-            package_string += f":{version}"
-        cmd = f"echo {package_string} >> {fh}"
-    run_subcommand(cmd)
+    package_string = ""
+    package_string += f"{package}"
+    if version:
+        package_string += f":{version}"
+    mask_file.append(package_string)
+    OUTPUT["modified"].append(
+        {"package": package, "ebuild_path": equery_which(package)}
+    )
 
 
-def add_package_use_mask(package, use_flag, version=""):
+def add_package_use_mask(mask_file, package, use_flag, version="", extend=None):
     """
-    adds an entry to the package.use.mask file at chromiumos-overlay/profiles/target/chromeos/
+    adds an entry masking `use_flag` for `package` to `mask_file`, the
+    package.use.mask file at chromiumos-overlay/profiles/target/chromeos/
 
+    if `package` already has an entry, `extend` decides whether the flag is
+    added to it, the user is asked if it's None
     """
-    global CHROMEOS_TARGET_PROFILES_ROOT, OUTPUT
-    fh = f"{CHROMEOS_TARGET_PROFILES_ROOT}/~package.use.mask"
     ebuild_path = equery_which(package)
     # check to see if the package is already masked
-    cmd = f"grep -n  {package} {fh}"
-    res = run_subprocess(cmd)
-    if res:
-        line, orig = res.split("\n").split(":")
-        add = prompt_yn(
-            f"the package {package} is already specified in the use mask file: {line}, {orig} -- edit existing file to add a new use mask?"
-        )
+    entry = mask_file.get(package)
+    if entry:
+        if use_flag in entry[1:]:
+            zprint(
+                f"not masking {use_flag} for the package: {package}, it's already masked",
+                debug=True,
+            )
+            return
+        add = extend
+        if add is None:
+            add = prompt_yn(
+                f"the package {package} is already specified in the use mask file: {' '.join(entry)} -- edit the existing entry to add a new use mask?"
+            )
         if add:
             zprint(
                 f"editing the existing mask the package:{package}", debug=True
             )
-            new = orig + f"{use_flag}"
-            cmd = f"sed s/orig/{new}/g {fh}"
-            run_subprocess(cmd)
+            mask_file.add_flag(package, use_flag)
         else:
             zprint(
                 f"not adding to the existing mask - add this mask manually",
@@ -251,35 +1269,18 @@ def add_package_use_mask(package, use_flag, version=""):
                     "use_flag": use_flag,
                 }
             )
-
+            return
     else:
         package_string = ""
         package_string += f"{package}"
         if version:
             package_string += f":{version}"
-        cmd = f"echo {package_string} >> {fh}"
-    run_subcommand(cmd)
+        mask_file.append(f"{package_string} {use_flag}")
     OUTPUT["modified"].append(
         {"package": package, "ebuild_path": ebuild_path, "use_flag": use_flag}
     )
 
 
-class Task:
-    def __init__(self, task, **kwargs):
-        self.task = task
-        self.kwargs = kwargs
-
-    def run_task(self):
-        if self.task == "pm":
-            add_package_mask(self.kwargs["package"])
-        if self.task == "pum":
-            add_package_use_mask(self.kwargs["package"], self.kwargs["useflag"])
-        if self.task == "mtf":
-            make_temporary_file(self.kwargs["file_"])
-        if self.task == "wtf":
-            write_temporary_file(self.kwargs["file_"])
-
-
 def get_atom_name(package_str, 
                   filepath=False):
     package={}
@@ -315,7 +1316,36 @@ def get_flag_name(flag_str):
     return flag
 
 class UseFlag:
-    def __init__(self, flag):
+    """
+    a use flag, as written, e.g. `+ssl` or `cups?`
+
+    flags are interned, every UseFlag of the same string is the same object
+    """
+
+    __slots__ = (
+        "name",
+        "optional",
+        "original",
+        "enabled",
+        "disabled",
+        "testing",
+        "default",
+        "toggle",
+        "condition",
+    )
+    _interned = {}
+
+    def __new__(cls, flag):
+        self = cls._interned.get(flag)
+        if self is None:
+            self = cls._interned[flag] = super().__new__(cls)
+            self._init(flag)
+        return self
+
+    def __getnewargs__(self):
+        return (self.original,)
+
+    def _init(self, flag):
         flag=get_flag_name(flag)
         self.name=flag.get("name")
         self.optional=flag.get("optional")
@@ -348,7 +1378,8 @@ class UseFlag:
         e.g. a flag in package X can be optional, but in Y can be required
 
         Thus, UseFlag objects can only be used in the context of a package, and not individually
-        as singletons
+        as singletons - as flags are interned, this toggles the flag everywhere it's written
+        the same way
         """
         self.toggle = True
 
@@ -358,47 +1389,100 @@ class UseFlag:
 
 
 class Package:
+    """
+    a package, and the content of its ebuild once parsed
+
+    packages are interned by name (the category/package, see `cp_name`),
+    every Package of the same name is the same object and is parsed at most
+    once. the ebuild's path is only looked up when it's first needed, unless
+    it's given as `filepath`
+
+    `dependencies` and `useflags` are dicts of name -> Dependency/UseFlag,
+    in the order they're declared
+    """
+
     p_use = re.compile("(I|REQUIRED_)?USE")
-    p_depend = re.compile("(B|C|R|P|[\w]+)_?(DEP)(END)?")
+    # every *DEPEND variable, e.g. DEPEND, RDEPEND, BDEPEND, COMMON_DEPEND
+    p_depend = re.compile(r"^(\w+_)?[BCIPR]?DEPEND$")
+    __slots__ = (
+        "fullname",
+        "name",
+        "_filepath",
+        "dependencies",
+        "useflags",
+        "metadata",
+        "_by_flag",
+    )
+    _interned = {}
+    _unresolved = object()
 
-    def __init__(self, name, parse_ebuild=False):
-        self.fullname = name
-        package, filepath=get_atom_name(name, filepath=True)
-        self.filepath = filepath
+    def __new__(cls, name, parse_ebuild=False, parsed=None, filepath=None):
         # get the name of the package without versioning/revisions
-        self.name=package["atom"]
-        self.dependencies = []
-        self.useflags = []
-        self.metadata = None
+        atom = cp_name(name)
+        self = cls._interned.get(atom)
+        if self is None:
+            self = cls._interned[atom] = super().__new__(cls)
+            self.fullname = name
+            self.name = atom
+            self._filepath = cls._unresolved
+            self.dependencies = {}
+            self.useflags = {}
+            self.metadata = None
+            # what `get_dependencies` returns, kept up to date as
+            # dependencies are added
+            self._by_flag = {
+                True: {"nonoptional": []},
+                False: {"nonoptional": []},
+            }
+        if filepath and self._filepath is cls._unresolved:
+            self._filepath = filepath
+        return self
+
+    def __init__(self, name, parse_ebuild=False, parsed=None, filepath=None):
+        if self.metadata is not None or not (parse_ebuild or parsed):
+            return
         if not self.filepath:
             return
-        if self.filepath is not None and parse_ebuild:
-            self._parse_ebuild()
+        if parsed:
+            # already parsed elsewhere, e.g. by `parse_packages`
+            self._load_parsed(parsed)
+        elif parse_ebuild:
+            parsed = None
+            if EBUILD_CACHE:
+                parsed = EBUILD_CACHE.get(self.filepath)
+            if parsed:
+                self._load_parsed(parsed)
+            else:
+                self._parse_ebuild()
+                if EBUILD_CACHE:
+                    EBUILD_CACHE.put(self.filepath, self.to_dict())
+
+    @property
+    def filepath(self):
+        if self._filepath is Package._unresolved:
+            self._filepath = equery_which(self.name)
+        return self._filepath
+
     def print_ebuild(self):
         content = read_content(self.filepath)
         print(content)
 
     def get_use_flags(self):
-        return [str(x) for x in self.useflags]
+        return [str(x) for x in self.useflags.values()]
 
     def get_dependencies(self, return_packages=False):
-        deps= {"nonoptional": []}
-        print(self.dependencies)
-        for d in self.dependencies:
-            if d.useflag:
-                if d.useflag.name  not in deps.keys():
-                    deps[d.useflag.name] = []
-                if return_packages:
-                    deps[d.useflag.name].append(d)
-                else:
-                    deps[d.useflag.name].append(d.name)
-            else:
-                if return_packages:
-                    deps["nonoptional"].append(d)
-                else:
-                    deps["nonoptional"].append(d.name)
+        """
+        the dependencies grouped by the name of the useflag toggling them,
+        or "nonoptional"
+
+        the returned dict is shared, and shouldn't be modified
+
+        Returns:
+            a dict of flag -> [Dependency] if `return_packages`, else
+            flag -> [dependency name]
+        """
+        return self._by_flag[return_packages]
 
-        return deps       
     def _parse_ebuild(self):
         """
         parses an ebuild file - adds all dependencies
@@ -406,227 +1490,192 @@ class Package:
 
         adds all useflags to `self.useflags`
 
-        rather than use the built in `equery` tool, this reads the content directly and uses
-        regex to parse the pattern
+        rather than use the built in `equery` tool, this reads the content directly and
+        parses the events of `lex_ebuild` in a single pass
         """
-        ebuild_raw = read_content(self.filepath).replace("\t", " ")
-        ebuild=ebuild_raw.split)("\n")
+        events = lex_ebuild(read_content(self.filepath))
         metadata = {}
-    }
-        
-        for i in range(0, len(ebuild)):
-            # filter comments
-            line = patterns["comment"].sub("", ebuild[i])
-            match_sd = patterns["start_declaration"].search(line)
-            if match_sd:
-                declaration = (
-                    match_sd.group(0).replace('="', "").replace("+", "")
-                )
-                s_idx = i
-                e_idx = i
-                content = patterns["start_declaration"].sub("", line)
-                match_end = patterns["end_quote"].match(content)
-                while not match_end:
-                    e_idx += 1
-                    content += ebuild[e_idx]
-                    match_end = patterns["end_quote"].match(ebuild[e_idx])
-
-                if Package.p_depend.match(declaration):
-                    i, tokens, e =self._set_dependencies(tokenize(content))
-                    if e:
-                        print(i)
-                        print(tokens)
-                        print(e)
-                elif Package.p_use.match(declaration):
-                    if declaration=="REQUIRED_USE":
-                        self._set_required_use(tokenize(content))
-                    else:
-                        self._set_useflags(tokenize(content))
-                metadata[declaration] = content
-        for k, v in metadata.items():
-            if k in dir(self):
-                attr = getattr(self, k)
-                attr += v
-                setattr(self, k, v)
+        for kind, value in events:
+            if kind != "declaration":
+                continue
+            declaration, append = value
+            # each handler consumes the events of the declaration's value
+            if Package.p_depend.match(declaration):
+                content = self._set_dependencies(events)
+            elif declaration == "REQUIRED_USE":
+                content = self._set_required_use(events)
+            elif Package.p_use.match(declaration):
+                content = self._set_useflags(events)
             else:
-                setattr(self, k, v)
+                content = self._skip_declaration(events)
+            if append and declaration in metadata:
+                content = f"{metadata[declaration]} {content}"
+            metadata[declaration] = content
+        self._set_metadata(metadata)
+
+    @staticmethod
+    def _skip_declaration(events):
+        """consumes the events of a declaration, returns its raw value"""
+        for kind, value in events:
+            if kind == "end":
+                return value
+
+    def _set_metadata(self, metadata):
         self.metadata = metadata
 
+    def to_dict(self):
+        """
+        the parsed content of the ebuild as plain data, the inverse of
+        `_load_parsed`
+        """
+        return {
+            "metadata": self.metadata,
+            "useflags": [f.original for f in self.useflags.values()],
+            "dependencies": [
+                (d.fullname, d.useflag.name if d.useflag else None)
+                for d in self.dependencies.values()
+            ],
+        }
+
+    def _load_parsed(self, parsed):
+        """restores the content of `to_dict` without parsing the ebuild"""
+        for f in parsed["useflags"]:
+            self._add_useflag(UseFlag(f))
+        for name, flag in parsed["dependencies"]:
+            useflag = self._get_flag(flag) if flag else None
+            self._add_dependency(Dependency(name, self, useflag=useflag))
+        self._set_metadata(parsed["metadata"])
+
     def _add_dependency(self, d):
-        if d.name not in [x.name for x in self.dependencies]:
-            self.dependencies.append(d)
+        if d.name in self.dependencies:
+            return
+        self.dependencies[d.name] = d
+        flag = d.useflag.name if d.useflag else "nonoptional"
+        for return_packages, value in ((True, d), (False, d.name)):
+            self._by_flag[return_packages].setdefault(flag, []).append(value)
 
-    def _set_dependencies(self, tokens):
+    def _set_dependencies(self, events):
         """
-        sets dependencies
+        consumes the events of a *DEPEND declaration, adding each atom as a
+        dependency
+
+        a dependency can be toggled by the innermost use conditional it's in,
+        which can be declared with or without parenthesis
+        e.g. cups? ( net-lib/wireless ) OR
+        !cups? package/my-atom:2
+        or nested
+        flag? (
+          flag2? (
+              >=blah
+           )
+        )
+
+        blockers (!atom, !!atom) are skipped
+
+        Returns:
+            the raw value of the declaration
+        """
+        # the conditional (or None) that opened each enclosing paren
+        scopes = []
+        conditional = None
+        for kind, value in events:
+            if kind == "end":
+                return value
+            if kind == "conditional":
+                conditional = UseFlag(value)
+                continue
+            if kind == "paren":
+                if value == "(":
+                    scopes.append(conditional)
+                elif scopes:
+                    scopes.pop()
+            elif (
+                kind == "token"
+                and patterns["atom"].match(value)
+                and not value.startswith("!")
+            ):
+                flag = conditional
+                for scope in reversed(scopes):
+                    if flag:
+                        break
+                    flag = scope
+                if flag:
+                    self._add_useflag(flag)
+                name = cp_name(value)
+                self._add_dependency(Dependency(name, self, useflag=flag))
+            conditional = None
 
-        where t[0] is the use flag if the dependency can be toggled in the ebuild, else None
-        and t[1] is the dependency
-    
-        """        
-        dependencies = []
-        i = 0
-        try:
-            while i < len(tokens):
-                token = tokens[i]
-                if patterns["atom"].match(token):
-                    # the token is a non-toggleable dependency
-                    _ = get_atom_name(token)["atom"]
-                    dep=Dependency(_, self)
-                    dependencies.append(dep)
-                elif patterns["inclusive_or"].match(token):
-                    while token != "(":
-                        token = tokens[i]
-                        i+=1
-                    while token != ")":
-                        token = tokens[i]
-                        i+=1
-                        if patterns["atom"].match(token):
-                            _ = get_atom_name(token)["atom"]
-                            dep=Dependency(_, self)
-                            dependencies.append(dep)
-                elif patterns["exclusive_or"].match(token):
-                    while token != "(":
-                        i += 1
-                        token = tokens[i]
-                    while token != ")":
-                        i += 1
-                        token = tokens[i]
-                        if patterns["atom"].match(token):
-                            _ = get_atom_name(token)["atom"]
-                            dep=Dependency(_, self)
-                            dependencies.append(dep)
-                elif patterns["at_most"].match(tokens[i]):
-                    token = tokens[i]
-                    while token != "(":
-                        i += 1
-                        token = tokens[i]
-                    while token != ")":
-                        i += 1
-                        token = tokens[i]
-                        if patterns["atom"].match(token):
-                            _ = get_atom_name(token)["atom"]
-                            dep=Dependency(_, self)
-                            dependencies.append(dep)
-                elif patterns["flag"].match(token):
-                    # a flag can be declared with or without parenthesis
-                    # e.g. cups? ( net-lib/wireless ) OR
-                    # !cups? !package/my-atom:2
-                    # or nested
-                    # flag? (
-                    #   flag2? (
-                    #       >=blah
-                    #    )
-                    #)
-                    flag = UseFlag(token)
-                    if tokens[i+1] < len(tokens):
-                        i+=1
-                        if token == "(":
-                            while token != ")":
-                                i+1
-                                token=tokens[i]
-                                if self._is_useflag(token):
-                                    subflag=UseFlag(token)
-                                    if tokens[i+1] < len(tokens):
-                                        i+1
-                                        subtoken=tokens[i]
-                                        if subtoken == "(":
-                                            while subtoken != ")":
-                                                i+1
-                                                subtoken=tokens[i]
-                                                if patterns["atom"].match(subtoken):
-                                                    _ = get_atom_name(subtoken)["atom"]
-                                                    dep=Dependency(_, self, useflag=subflag)
-                                                    dependencies.append(dep)
-                                elif patterns["atom"].match(token):
-                                    _ = get_atom_name(token)["atom"]
-                                    dep=Dependency(_,self,useflag=flag)
-                                    dependencies.append(dep)
-
-
-                i += 1
-            for d in dependencies:
-                if d.useflag:
-                    self._add_useflag(d.useflag)         
-                self._add_dependency(d)
-
-        except Exception as e: 
-            return (i, tokens, e)
-    
-        finally:
-            return (None, None,  None)
     def _add_useflag(self, useflag):
-        if not useflag.name in [x.name for x in self.useflags]:
-            self.useflags.append(useflag)
+        self.useflags.setdefault(useflag.name, useflag)
         return useflag
 
-    def _set_useflags(self, tokens):
-
-        useflags = []
-        i = 0
-        while i < len(tokens):
-            token = tokens[i]
-            if self._is_flag(token):
-                flag = UseFlag(token)
-                useflags.append(flag)
-            elif tokens[i] == "(":
-                i += 1
-                token = tokens[i]
-                while token != ")":
-                    if self._is_flag(token):
-                        flag = UseFlag(token)
-                        useflags.append(flag)
-                    i += 1
-                    token = tokens[i]
-            i += 1
-        for f in useflags:
-            self._add_useflag(f)
+    def _set_useflags(self, events):
+        """
+        consumes the events of an IUSE declaration, adding each flag
+
+        Returns:
+            the raw value of the declaration
+        """
+        for kind, value in events:
+            if kind == "end":
+                return value
+            if kind == "token" and self._is_flag(value):
+                self._add_useflag(UseFlag(value))
 
     def _get_flag(self, flag_str):
         f = get_flag_name(flag_str)["name"]
-        for i,_f in enumerate(self.useflags):
-            if _f.name==f:
-                flag=self.useflags[i]
-                return flag
-        return UseFlag(flag_str)
+        return self.useflags.get(f) or UseFlag(flag_str)
     @staticmethod
     def _is_flag(flag_str):
         if patterns["flag"].match(flag_str):
             return True
             
-    def _set_required_use(self, tokens):
-        useflags = []
-        i = 0
-        while i < len(tokens):
-            token = tokens[i]
-            if  self._is_flag(token):
-                flag = self._get_flag(token)
-                useflags.append(flag)
-            if token == "(":
-                while token != ")":
-                    i+=1
-                    token=tokens[i]
-                    if self._is_flag(token):
-                        flag=self._get_flag(token)
-                        useflags.append(flag)
-            i += 1
-        for f in useflags:
-            self._add_useflag(f)
-
-class Dependency(Package):
-    def __init__(self, name, parent=None, useflag=None, parse_ebuild=False):
-        super().__init__(name, parse_ebuild=parse_ebuild)
+    def _set_required_use(self, events):
+        """
+        consumes the events of a REQUIRED_USE declaration, adding each flag
+        it mentions
+
+        Returns:
+            the raw value of the declaration
+        """
+        for kind, value in events:
+            if kind == "end":
+                return value
+            if kind in ("token", "conditional") and self._is_flag(value):
+                self._add_useflag(self._get_flag(value))
+
+class Dependency:
+    """
+    an edge from `parent` to the (interned) package `name`, toggled by
+    `useflag` if it's optional
+
+    anything else, e.g. `name` or `filepath`, is read from the package
+    """
+
+    __slots__ = ("package", "parent", "useflag")
+
+    def __init__(
+        self, name, parent=None, useflag=None, parse_ebuild=False, parsed=None
+    ):
+        self.package = Package(name, parse_ebuild=parse_ebuild, parsed=parsed)
         self.parent=parent
         self.useflag=useflag
 
+    def __getattr__(self, attr):
+        # only called for attributes that aren't (set) slots
+        if attr == "package":
+            raise AttributeError(attr)
+        return getattr(self.package, attr)
+
     def add_useflag(self, useflag):
         self.useflag = useflag
 
     def __str__(self):
-        if self.is_toggleable:
-            return f"{parent.name} -> self.name, toggle:{self.useflag.flag}"
+        parent = self.parent.name if self.parent else None
+        if self.is_toggleable():
+            return f"{parent} -> {self.name}, toggle:{self.useflag.name}"
         else:
-            return f"{parent.name} -> self.name (nontoggleable)"
+            return f"{parent} -> {self.name} (nontoggleable)"
     def is_toggleable(self):
         return True if self.useflag else False
 
@@ -635,15 +1684,20 @@ class Task:
         self.task = task
         self.kwargs = kwargs
 
-    def run_task(self):
+    def run_task(self, mask_files):
+        """
+        applies the task to `mask_files`, a dict of task -> MaskFile, i.e.
+        "pm" -> package.mask and "pum" -> package.use.mask
+        """
         if self.task == "pm":
-            add_package_mask(self.kwargs["package"])
+            add_package_mask(mask_files["pm"], self.kwargs["package"])
         if self.task == "pum":
-            add_package_use_mask(self.kwargs["package"], self.kwargs["useflag"])
-        if self.task == "mtf":
-            make_temporary_file(self.kwargs["file_"])
-        if self.task == "wtf":
-            write_temporary_file(self.kwargs["file_"])
+            add_package_use_mask(
+                mask_files["pum"],
+                self.kwargs["package"],
+                self.kwargs["useflag"],
+                extend=self.kwargs.get("extend"),
+            )
 
 
 
@@ -668,6 +1722,12 @@ def equery_which(package, options=[]):
     option_string = ""
     if options:
         option_string += " ".join([o for o in options])
+    if not options:
+        res = EBUILD_INDEX.which(package)
+        if not res and EBUILD_CACHE:
+            res = EBUILD_CACHE.which(package)
+        if res:
+            return res
     cmd = f"equery -C which {package} {option_string}"
     res=None
     try:
@@ -679,6 +1739,8 @@ def equery_which(package, options=[]):
 
     if res:
         res = res.replace("\n", "")
+        if EBUILD_CACHE and not options and os.path.exists(res):
+            EBUILD_CACHE.put_which(package, res)
     return res
 
 def equery_list(package, options=[]):
@@ -780,11 +1842,21 @@ def try_remove_package(package):
         ),
         "exit": "user cancelled, no changes made",
     }
-    dependencies=equery_depends(package)
-    for dependency in dependencies:
-        d_name=get_atom_name(dependency)["atom"]
+    dependencies=reverse_dependencies(package)
+    # parse every dependent up front, in parallel, before prompting
+    parsed = {
+        name: p for name, _, p in parse_packages(
+            cp_name(d) for d in dependencies
+        )
+    }
+    for dependency, condition in dependencies.items():
+        d_name=cp_name(dependency)
         
-        d=Dependency(d_name, parse_ebuild=True)
+        d=Dependency(d_name, parsed=parsed.get(d_name))
+        if condition and not condition.startswith("!"):
+            # the dependency only exists behind `condition?`, a `!condition?`
+            # dependency can't be dropped by masking the flag
+            d.add_useflag(UseFlag(f"{condition}?"))
         pprint.pprint(d.metadata)
         pprint.pprint(d.get_use_flags())
         pprint.pprint(d.get_dependencies(return_packages=False))
@@ -796,7 +1868,7 @@ def try_remove_package(package):
             package_use_masks.append((d.name, useflag))
         else:
             # check if upstream dependencies
-            subdeps = equery_depends(d.name)
+            subdeps = reverse_dependencies(d.name)
             proceed = False
             if not subdeps:
                 proceed = prompt_yn(
@@ -836,57 +1908,185 @@ def try_remove_package(package):
         print(messages["exit"])
 
 
-def run_tasks(task_list):
-    # make a local copy to add pre-post tasks
-    from collections import deque
+def load_policy(path=None):
+    """
+    reads a batch mode policy file, see `DEFAULT_POLICY`
 
-    tasks_ = deque()
-    ok = prompt_yn(f"run all tasks to complete removal?")
-    if ok:
-        tasks_.appendleft(
-            Task(
-                "mtf",
-                file_=f"{CHROMEOS_TARGET_PROFILES_ROOT}/package.mask",
-            )
-        )
-        tasks_.appendleft(
-            Task(
-                "mtf",
-                file_=f"{CHROMEOS_TARGET_PROFILES_ROOT}/package.use.mask",
-            )
-        )
+    Returns:
+        the policy, `DEFAULT_POLICY` updated with the file's content
+    """
+    policy = dict(DEFAULT_POLICY)
+    if path:
+        with open(path) as fh:
+            policy.update(yaml.safe_load(fh) or {})
+    unknown = set(policy) - set(DEFAULT_POLICY)
+    if unknown:
+        raise ValueError(f"unknown policy keys in {path}: {sorted(unknown)}")
+    for k, choices in POLICY_CHOICES.items():
+        if policy[k] not in choices:
+            raise ValueError(f"policy {k} must be one of {choices}, not {policy[k]}")
+    policy["exclude"] = {cp_name(p) for p in policy["exclude"]}
+    return policy
+
+
+def plan_removal(packages, policy):
+    """
+    the non-interactive counterpart of `try_remove_package`, for any number
+    of packages
+
+    every package is analysed against the one reverse dependency index, and
+    the decisions `try_remove_package` would ask about are answered by
+    `policy`: a non-toggleable dependent with no reverse dependencies of its
+    own is masked, a toggleable dependent has the flag masked, anything else
+    is reported
+
+    Returns:
+        the merged plan, a dict of
+          "packages": the packages being removed
+          "package_masks": [package]
+          "package_use_masks": [(package, useflag)]
+          "nonoptional_dependencies": {package: [packages it depends on]}
+    """
+    packages = list(dict.fromkeys(cp_name(p) for p in packages))
+    package_masks = {}
+    package_use_masks = {}
+    nonoptional_dependencies = {}
+    removing = set(packages)
+    rdeps = {}
+
+    def reverse_dependencies_(package):
+        # dependents are often shared between packages, only ask once
+        if package not in rdeps:
+            rdeps[package] = reverse_dependencies(package)
+        return rdeps[package]
+
+    for package in packages:
+        for dependent, condition in reverse_dependencies_(package).items():
+            if dependent in removing:
+                # being removed anyway
+                continue
+            if dependent in policy["exclude"]:
+                decision = "report"
+            elif condition and not condition.startswith("!"):
+                # masking the flag can't drop a `!flag?` dependency
+                decision = policy["toggleable"]
+            elif not reverse_dependencies_(dependent):
+                decision = policy["no_reverse_dependencies"]
+            else:
+                decision = "report"
+            zprint(f"{package} <- {dependent} ({condition}): {decision}", debug=True)
+            if decision == "use_mask":
+                package_use_masks.setdefault((dependent, condition), None)
+            elif decision == "mask":
+                package_masks.setdefault(dependent, None)
+            else:
+                nonoptional_dependencies.setdefault(dependent, []).append(package)
+    return {
+        "packages": packages,
+        "package_masks": list(package_masks),
+        "package_use_masks": list(package_use_masks),
+        "nonoptional_dependencies": nonoptional_dependencies,
+    }
 
-        for t in task_list:
-            tasks_.appendleft(t)
-        tasks.appendleft(
-            Task(
-                "wtf",
-                file_=f"{CHROMEOS_TARGET_PROFILES_ROOT}/package.mask",
-            )
-        )
-        tasks.appendleft(
-            Task(
-                "wtf",
-                file_=f"{CHROMEOS_TARGET_PROFILES_ROOT}/package.use.mask",
-            )
-        )
 
-    current = tasks_.pop()
-    while current:
-        current.run_task()
-        current = tasks_.pop()
+def batch_remove_packages(
+    packages,
+    policy,
+    dry_run=False,
+    plan_path=None,
+    transitive=False,
+    assignment=None,
+    confirm=False,
+):
+    """
+    plans the removal of `packages` with `plan_removal`, or with
+    `ReverseDependencyGraph.minimal_cut` under `assignment` if `transitive`,
+    prints the plan and unless `dry_run`, applies it - asking first if
+    `confirm`
 
+    Returns:
+        the plan
+    """
+    if transitive:
+        plan = ReverseDependencyGraph(assignment).minimal_cut(packages, policy)
     else:
+        plan = plan_removal(packages, policy)
+    print(batch_report.render(**plan))
+    if plan_path:
+        with open(plan_path, "w") as fh:
+            json.dump(plan, fh, indent=2)
+    if dry_run:
+        return plan
+    tasks = [Task("pm", package=p) for p in plan["package_masks"]]
+    tasks += [
+        Task("pum", package=p, useflag=flag, extend=policy["extend_use_mask"])
+        for p, flag in plan["package_use_masks"]
+    ]
+    if confirm:
+        run_tasks(tasks)
+    else:
+        apply_tasks(tasks)
+    return plan
+
+
+def run_tasks(task_list):
+    """
+    applies every task to package.mask and package.use.mask, each file is
+    read once and written once
+    """
+    ok = prompt_yn(f"run all tasks to complete removal?")
+    if not ok:
         print("user cancelled - no changes made")
         sys.exit(1)
+    apply_tasks(task_list)
+
+
+def apply_tasks(task_list):
+    """`run_tasks`, without asking first"""
+    mask_files = {
+        "pm": MaskFile(f"{CHROMEOS_TARGET_PROFILES_ROOT}/package.mask"),
+        "pum": MaskFile(f"{CHROMEOS_TARGET_PROFILES_ROOT}/package.use.mask"),
+    }
+    for task in task_list:
+        task.run_task(mask_files)
+    for mask_file in mask_files.values():
+        mask_file.write()
 
 
 def main(argv: Optional[List[str]]) -> Optional[int]:
     """Main."""
-    global DEBUG, OUTPUT
+    global DEBUG, OUTPUT, CLEAN, JOBS, EBUILD_CACHE, EBUILD_INDEX
     commandline.RunInsideChroot()
     parser = get_parser()
     opts = parser.parse_args(argv)
     if opts.verbose:
         DEBUG = True
-    try_remove_package(opts.package)
+    CLEAN = opts.clear_cache
+    JOBS = opts.jobs
+    if opts.overlay:
+        EBUILD_INDEX = EbuildIndex(opts.overlay + EBUILD_INDEX.overlays)
+    if opts.no_cache:
+        EBUILD_CACHE = None
+    elif CLEAN:
+        EBUILD_CACHE.clear()
+    packages = list(opts.package)
+    if opts.package_list:
+        for line in read_content(opts.package_list).splitlines():
+            line = line.split("#", 1)[0].strip()
+            if line:
+                packages.append(line)
+    if not packages:
+        parser.error("at least one of --package or --package-list is required")
+    if opts.policy or opts.transitive:
+        batch_remove_packages(
+            packages,
+            load_policy(opts.policy),
+            dry_run=opts.dry_run,
+            plan_path=opts.plan,
+            transitive=opts.transitive,
+            assignment=parse_use(opts.use),
+            confirm=not opts.policy,
+        )
+    else:
+        for package in packages:
+            try_remove_package(package)
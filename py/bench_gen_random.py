@@ -0,0 +1,189 @@
+## benchmarks for gen_random.py
+##
+## startup: cold start time of the default path (print one string) compared
+## with the interpreter floor and with the numpy/scipy imports it used to pay
+## on every call. pass --script to time another copy of gen_random.py, e.g.
+##
+##   git show <rev>:py/gen_random.py > /tmp/gen_random_old.py
+##   python bench_gen_random.py startup --script /tmp/gen_random_old.py
+##
+## throughput: sweeps string length, batch size and alphabet configuration,
+## reporting tokens/sec, bytes/sec, peak rss and divergence latency. each
+## configuration runs in a fresh process so peak rss is per configuration.
+## write the results with --output and diff them across versions, e.g.
+##
+##   python bench_gen_random.py throughput --output bench.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import platform
+import resource
+import statistics
+import multiprocessing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_command(cmd, runs=20):
+    """runs `cmd` `runs` times and returns the wall times in seconds"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times):
+    return {
+        "runs": len(times),
+        "min_ms": min(times) * 1000,
+        "mean_ms": statistics.mean(times) * 1000,
+        "stdev_ms": statistics.stdev(times) * 1000 if len(times) > 1 else 0.0,
+    }
+
+
+def bench_startup(script, runs=20):
+    cases = {
+        "interpreter": [sys.executable, "-c", "pass"],
+        "numpy+scipy imports": [
+            sys.executable, "-c", "import numpy; from scipy.stats import entropy"
+        ],
+        "gen_random.py": [sys.executable, script],
+    }
+    return {name: summarize(time_command(cmd, runs)) for name, cmd in cases.items()}
+
+
+ALPHABETS = {
+    "default": {},
+    "readable": {"readable": True},
+    "alpha": {"alpha": True},
+    "readable+alpha": {"readable": True, "alpha": True},
+}
+
+
+def bench_config(config):
+    """
+    runs one configuration, meant to be called in a fresh process
+
+    Returns:
+        a dict of results for the configuration
+    """
+    import gen_random
+    n, l, alphabet = config
+    gen = gen_random.PasswordGenerator(length=l, **ALPHABETS[alphabet])
+    result = {"count": n, "length": l, "alphabet": alphabet}
+
+    start = time.perf_counter()
+    gen.batch(n, packed=True)
+    elapsed = time.perf_counter() - start
+    result["batch_tokens_per_sec"] = n / elapsed
+    result["batch_bytes_per_sec"] = n * l / elapsed
+
+    # the one string at a time path, capped so small lengths don't take forever
+    m = min(n, 100000)
+    start = time.perf_counter()
+    for _ in range(m):
+        gen.generate()
+    elapsed = time.perf_counter() - start
+    result["sequence_tokens_per_sec"] = m / elapsed
+    result["sequence_bytes_per_sec"] = m * l / elapsed
+
+    m = min(n, 10000)
+    strings = gen.batch(m)
+    monitor = gen.monitor(window=100)
+    start = time.perf_counter()
+    for s in strings:
+        monitor.update(s)
+    result["divergence_update_us"] = (time.perf_counter() - start) / m * 1e6
+    runs = 100
+    start = time.perf_counter()
+    for _ in range(runs):
+        monitor.divergence()
+    result["divergence_us"] = (time.perf_counter() - start) / runs * 1e6
+
+    # ru_maxrss is in KB on linux and bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_mb"] = rss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+    return result
+
+
+def bench_throughput(lengths, counts, alphabets, max_bytes):
+    configs = [
+        (n, l, a)
+        for a in alphabets
+        for l in lengths
+        for n in counts
+        if n * l <= max_bytes
+    ]
+    results = []
+    sys.path.insert(0, HERE)
+    with multiprocessing.Pool(1, maxtasksperchild=1) as p:
+        for result in p.imap(bench_config, configs):
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def get_version():
+    try:
+        res = subprocess.run(
+            ["git", "-C", HERE, "describe", "--always", "--dirty"],
+            capture_output=True,
+            encoding="utf-8",
+        )
+        return res.stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="bench", required=True)
+    startup = sub.add_parser("startup")
+    startup.add_argument("--runs", type=int, default=20)
+    startup.add_argument("--script", default=os.path.join(HERE, "gen_random.py"))
+    throughput = sub.add_parser("throughput")
+    throughput.add_argument(
+        "--lengths", type=int, nargs="+", default=[20, 100, 1000, 10000]
+    )
+    throughput.add_argument(
+        "--counts", type=int, nargs="+", default=[1, 1000, 100000, 10000000]
+    )
+    throughput.add_argument(
+        "--alphabets", nargs="+", choices=list(ALPHABETS), default=list(ALPHABETS)
+    )
+    throughput.add_argument(
+        "--max-bytes", type=int, default=1 << 30,
+        help="skip configurations generating more than this many bytes",
+    )
+    for p in (startup, throughput):
+        p.add_argument("--output", default=None, help="write the json here")
+    args = parser.parse_args()
+
+    if args.bench == "startup":
+        results = bench_startup(args.script, args.runs)
+    elif args.bench == "throughput":
+        results = bench_throughput(
+            args.lengths, args.counts, args.alphabets, args.max_bytes
+        )
+    report = {
+        "benchmark": args.bench,
+        "version": get_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+## benchmarks for regexer.py
+##
+## trie: compares `regexer.trie` against a naive join of escaped literals
+## (sorted longest first so both match the same text) for growing numbers of
+## package atom like literals, e.g.
+##
+##   python bench_regexer.py trie --sizes 100 1000 10000
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+import regexer
+
+CATEGORIES = ["app-misc", "dev-libs", "net-libs", "sys-apps", "media-libs", "x11-libs"]
+
+
+def gen_atoms(n, rng):
+    """`n` distinct category/package style literals"""
+    atoms = set()
+    while len(atoms) < n:
+        name = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz-") for _ in range(rng.randint(3, 16)))
+        atoms.add(f"{rng.choice(CATEGORIES)}/{name.strip('-') or 'x'}")
+    return sorted(atoms)
+
+
+def naive(literals):
+    return "|".join(re.escape(l) for l in sorted(literals, key=len, reverse=True))
+
+
+def timed(f, *args, repeat=3):
+    """best of `repeat` runs, and the result of the last one"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_trie(sizes, lines, seed):
+    rng = random.Random(seed)
+    results = []
+    for n in sizes:
+        atoms = gen_atoms(n, rng)
+        # half the lines mention an atom, half only look like they might
+        text = [
+            f"emerge {rng.choice(atoms)} done" if i % 2 else f"emerge {gen_atoms(1, rng)[0]} done"
+            for i in range(lines)
+        ]
+        result = {"literals": n, "lines": lines}
+        for name, build in (("naive", naive), ("trie", regexer.trie)):
+            pattern = build(atoms)
+            re.purge()
+            compile_s, compiled = timed(re.compile, pattern, repeat=1)
+            search_s, found = timed(lambda: sum(1 for t in text if compiled.search(t)))
+            result[name] = {
+                "pattern_chars": len(pattern),
+                "compile_ms": compile_s * 1000,
+                "search_ms": search_s * 1000,
+                "lines_per_sec": lines / search_s,
+                "matches": found,
+            }
+        result["speedup"] = result["naive"]["search_ms"] / result["trie"]["search_ms"]
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="bench", required=True)
+    trie = sub.add_parser("trie")
+    trie.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    trie.add_argument("--lines", type=int, default=2000)
+    trie.add_argument("--seed", type=int, default=0)
+    trie.add_argument("--output", default=None, help="write the json here")
+    args = parser.parse_args()
+
+    if args.bench == "trie":
+        results = bench_trie(args.sizes, args.lines, args.seed)
+    report = {
+        "benchmark": args.bench,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+## checks for regexer.py
+##
+##   python check_regexer.py
+##
+## Scanner flags: a pattern's global inline flags ((?i)...) and the flags of
+## a compiled pattern are scoped to it in the merged pattern, including a
+## and L, which change what \w matches
+##
+## load_pattern: compiled patterns loaded for grep -p keep their flags,
+## inline or not, and match as the compiled pattern does
+
+import os
+import re
+import sys
+import tempfile
+
+import regexer
+
+TEXT = "ABC é xabc dd"
+
+# patterns -> the matches of `Scanner(patterns).scan(TEXT)`
+SCANNER_FLAGS = [
+    ({"a": "(?i)abc"}, [("a", (0, 3)), ("a", (7, 10))]),
+    ({"a": re.compile("(?i)abc")}, [("a", (0, 3)), ("a", (7, 10))]),
+    ({"a": re.compile("abc", re.I)}, [("a", (0, 3)), ("a", (7, 10))]),
+    ({"b": "(?s)(?i)x", "a": "abc"}, [("b", (6, 7)), ("a", (7, 10))]),
+    ({"a": r"(?a)\w+"}, [("a", (0, 3)), ("a", (6, 10)), ("a", (11, 13))]),
+    ({"a": re.compile(r"\w+", re.A)}, [("a", (0, 3)), ("a", (6, 10)), ("a", (11, 13))]),
+    # a verbose comment doesn't swallow the group closing the pattern
+    ({"a": "(?x) a b # c", "b": r"(d)\1"}, [("a", (7, 9)), ("b", (11, 13))]),
+]
+
+
+def check_scanner_flags():
+    for patterns, expected in SCANNER_FLAGS:
+        scanner = regexer.Scanner(patterns)
+        for buffer in (TEXT, TEXT.encode("latin-1")):
+            found = [(name, span) for name, span, _ in scanner.scan(buffer)]
+            assert found == expected, f"{patterns} on {buffer!r}: {found}, not {expected}"
+    # L is only allowed in bytes patterns, so it can only scan bytes
+    scanner = regexer.Scanner({"a": re.compile(rb"(?L)\w+")})
+    found = [span for _, span, _ in scanner.scan(TEXT.encode("latin-1"))]
+    assert found[0] == (0, 3), found
+    print(f"Scanner flags: {len(SCANNER_FLAGS) + 1} cases ok")
+
+
+# loaded by `check_load_pattern` as check_regexer:LOADED.<name>
+LOADED = {
+    "inline": re.compile("(?i)foo"),
+    "flags": re.compile("foo", re.I),
+    "both": re.compile("(?s)(?i)f.o", re.M),
+    "ascii": re.compile(r"\w+o", re.A),
+    "verbose": re.compile(rb"(?x) f o o # a comment"),
+}
+
+GREP_TEXT = "FOO\nxfoo bar\nf\noé\n"
+
+
+def check_load_pattern():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "text")
+        with open(path, "w") as fh:
+            fh.write(GREP_TEXT)
+        data = GREP_TEXT.encode("utf-8")
+        for name, compiled in LOADED.items():
+            pattern = regexer.load_pattern(f"check_regexer:LOADED.{name}")
+            found = [(o, t) for _, o, t in regexer.grep([path], pattern, jobs=1)]
+            bytes_pattern = compiled.pattern
+            if isinstance(bytes_pattern, str):
+                bytes_pattern = bytes_pattern.encode("utf-8")
+            expected = [
+                (m.start(), m.group())
+                for m in re.finditer(bytes_pattern, data, compiled.flags & ~re.UNICODE)
+            ]
+            assert found == expected, f"{name}: {found}, not {expected}"
+    print(f"load_pattern: {len(LOADED)} patterns ok")
+
+
+def main():
+    check_scanner_flags()
+    check_load_pattern()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,15 @@
+## numpy, scipy, asyncio and multiprocessing are imported where they're used,
+## so the default path (print one string) only pays for the stdlib
+import os
+import sys
 import random
 import time
 import argparse
-import numpy as np
-from scipy.stats import entropy
-from collections import Counter
+from collections import Counter, deque
+from functools import lru_cache
 from string import ascii_lowercase, ascii_uppercase
 
 
-parser = argparse.ArgumentParser()
-
-parser.add_argument("-l", "--len", default=20)
-parser.add_argument("-c", "--continuous", action="store_true", default=False)
-parser.add_argument("-r", "--readable", action="store_true", default=False)
-parser.add_argument("-a", "--alpha", action="store_true", default=False)
-
-args = parser.parse_args()
-
 chars = set(ascii_lowercase)
 chars = chars |  set(ascii_uppercase)
 digits = set([str(x) for x in range(0,9)])
@@ -24,22 +18,265 @@ ambiguous=set(["1","l","I","0","O","b","6"])
 
 all_syms = chars | digits | punc
 
-syms = all_syms
-if args.readable:
-    syms = syms - ambiguous
-if args.alpha:
-    syms = syms - punc
 
-syms = list(syms)
+def get_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-l", "--len", type=int, default=20)
+    parser.add_argument("-n", "--count", type=int, default=None)
+    parser.add_argument("-w", "--window", type=int, default=100)
+    parser.add_argument("-d", "--decay", type=float, default=None)
+    parser.add_argument("-c", "--continuous", action="store_true", default=False)
+    parser.add_argument("-r", "--readable", action="store_true", default=False)
+    parser.add_argument("-a", "--alpha", action="store_true", default=False)
+    parser.add_argument("--symbols", default=None, help="use exactly these symbols")
+    parser.add_argument(
+        "-b", "--backend", choices=["random", "secrets", "urandom", "pcg64"], default="random"
+    )
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("-s", "--seed", type=int, default=None)
+    parser.add_argument("-o", "--output", default=None)
+    parser.add_argument("--shard-size", type=int, default=100000)
+    parser.add_argument("--unordered", action="store_true", default=False)
+    parser.add_argument("--audit", action="store_true", default=False)
+    parser.add_argument("--rate", type=float, default=2.0)
+    return parser
+
+
+def get_alphabet(readable=False, alpha=False, symbols=None):
+    """
+    the alphabet for a configuration, as a fixed order bytes table
+
+    the set algebra runs once per configuration, after that the cached bytes
+    are returned. the symbols are sorted so the alphabet order, and therefore
+    seeded output, is stable across runs
+
+    Args:
+        readable    : drop the `ambiguous` symbols
+        alpha       : drop the `punc` symbols
+        symbols     : if set, start from these symbols instead of `all_syms`
+    """
+    return _alphabet(readable, alpha, frozenset(symbols) if symbols else None)
+
+@lru_cache(maxsize=None)
+def _alphabet(readable, alpha, symbols):
+    syms = symbols if symbols else all_syms
+    if readable:
+        syms = syms - ambiguous
+    if alpha:
+        syms = syms - punc
+    alphabet = "".join(sorted(syms)).encode("ascii")
+    if not alphabet or len(alphabet) > 256:
+        raise ValueError(f"an alphabet needs 1-256 symbols, got {len(alphabet)}")
+    return alphabet
+
+@lru_cache(maxsize=None)
+def get_tables(alphabet):
+    """
+    the numpy side of an alphabet, built on first use
+
+    Returns:
+        sym_table       : symbol index -> ascii byte
+        sym_index       : ascii byte -> symbol index (-1 if not in the alphabet)
+        uniform_dist    : the expected distribution of symbols
+    """
+    import numpy as np
+    sym_table = np.frombuffer(alphabet, dtype=np.uint8)
+    sym_index = np.full(256, -1, dtype=np.int16)
+    sym_index[sym_table] = np.arange(len(alphabet))
+    # a uniform dist is max entropy - each character observed equally
+    uniform_dist = np.array([1/len(alphabet) for x in range(0, len(alphabet))])
+    return sym_table, sym_index, uniform_dist
+
+@lru_cache(maxsize=None)
+def get_translation(alphabet):
+    """
+    the bytes.translate arguments used by `EntropyPool` for an alphabet
+
+    a byte b is kept only if it's below the largest multiple of len(alphabet)
+    that fits in a byte, and maps to alphabet[b % len(alphabet)]
+
+    Returns:
+        table, delete, and the fraction of bytes that are kept
+    """
+    k = len(alphabet)
+    limit = 256 - 256 % k
+    table = bytes(alphabet[b % k] if b < limit else 0 for b in range(256))
+    return table, bytes(range(limit, 256)), limit / 256
+
+# the backends that take a seed, the others read from the os
+SEEDABLE_BACKENDS = ("random", "pcg64")
+
+def get_backend(name, seed=None):
+    """
+    returns a callable(n) -> n random bytes for the named backend
+
+    `seed` only applies to the non cryptographic backends (random, pcg64),
+    it can be an int or a numpy SeedSequence. seeding another backend is an
+    error, as its output can't be reproduced
+    """
+    if seed is not None and name in ("secrets", "urandom"):
+        raise ValueError(f"the {name} backend can't be seeded")
+    if name == "random":
+        if seed is None:
+            return random.randbytes
+        if hasattr(seed, "generate_state"):
+            # a numpy SeedSequence
+            seed = int.from_bytes(seed.generate_state(4).tobytes(), "little")
+        return random.Random(seed).randbytes
+    if name == "secrets":
+        import secrets
+        return secrets.token_bytes
+    if name == "urandom":
+        return os.urandom
+    if name == "pcg64":
+        import numpy as np
+        return np.random.Generator(np.random.PCG64(seed)).bytes
+    raise ValueError(f"unknown backend: {name}")
+
+class EntropyPool:
+    """
+    reads random bytes from a backend in large blocks and turns them into
+    symbols with unbiased rejection sampling
+
+    the rejection and the mapping to symbols are a single bytes.translate
+    over the block (see `get_translation`), so there's no per character
+    work in python and no syscall per character for the os backed sources
+
+    Args:
+        alphabet    : the symbols, as returned by `get_alphabet`
+        backend     : one of random, secrets, urandom, pcg64
+        block_size  : the number of bytes read from the backend at a time
+        seed        : passed to `get_backend`
+    """
+    def __init__(self, alphabet, backend="random", block_size=1 << 16, seed=None):
+        self.alphabet = alphabet
+        self._table, self._reject, self._accept = get_translation(alphabet)
+        self._read = get_backend(backend, seed)
+        self.block_size = block_size
+        self._buf = bytearray()
+        self._pos = 0
+
+    def take(self, n):
+        """returns `n` symbols as ascii bytes"""
+        while len(self._buf) - self._pos < n:
+            # drop what's been consumed and reuse the buffer
+            del self._buf[:self._pos]
+            self._pos = 0
+            missing = n - len(self._buf)
+            size = max(self.block_size, int(missing / self._accept) + 64)
+            self._buf += self._read(size).translate(self._table, self._reject)
+        out = bytes(self._buf[self._pos:self._pos + n])
+        self._pos += n
+        return out
+
+@lru_cache(maxsize=None)
+def get_pool():
+    """the pool behind the module level functions: default alphabet and backend"""
+    return EntropyPool(get_alphabet())
+
+def gen_sequence(l=20, pool=None):
+    pool = pool or get_pool()
+    return pool.take(l).decode("ascii")
+
+def gen_batch(n, l=20, packed=False, sep="", pool=None):
+    """
+    generates `n` strings of length `l` in one shot
+
+    all n*l symbols are drawn from the pool at once and split with numpy,
+    so there is no interpreter round trip per character
+
+    Args:
+        n       : the number of strings
+        l       : the length of each string
+        packed  : if True, return a single bytes buffer instead of a list
+        sep     : appended to each string in the packed buffer, e.g. "\n"
+        pool    : the `EntropyPool` to draw from
+    """
+    pool = pool or get_pool()
+    raw = pool.take(n * l)
+    if sep:
+        import numpy as np
+        out = np.empty((n, l + len(sep)), dtype=np.uint8)
+        out[:, :l] = np.frombuffer(raw, dtype=np.uint8).reshape(n, l)
+        out[:, l:] = np.frombuffer(sep.encode("ascii"), dtype=np.uint8)
+        raw = out.tobytes()
+    if packed:
+        return raw
+    raw = raw.decode("ascii")
+    step = l + len(sep)
+    return [raw[i:i + l] for i in range(0, len(raw), step)]
+
+def write_batch(n, l=20, chunk=100000, out=None, pool=None):
+    """
+    writes `n` newline separated strings to `out`, `chunk` strings at a time
+    so memory stays bounded for very large n
+    """
+    out = out or sys.stdout.buffer
+    while n > 0:
+        size = min(n, chunk)
+        out.write(gen_batch(size, l, packed=True, sep="\n", pool=pool))
+        n -= size
+    out.flush()
+
+def _gen_shard(job):
+    n, l, alphabet, backend, seed = job
+    pool = EntropyPool(alphabet, backend, seed=seed)
+    return gen_batch(n, l, packed=True, sep="\n", pool=pool)
+
+def gen_sharded(n, l=20, alphabet=None, workers=1, seed=None, backend="pcg64",
+                shard_size=100000, ordered=True):
+    """
+    generates `n` newline separated strings across a process pool, yielding
+    one packed bytes shard at a time
+
+    the job is always cut into shards of `shard_size` strings, and shard i
+    is seeded with the i-th child of SeedSequence(seed). the output for a
+    given seed is therefore byte identical whatever the number of workers
 
-# a uniform dist is max entropy - each character observed equally
-uniform_dist = np.array([1/len(syms) for x in range(0, len(syms))])
+    Args:
+        n           : the number of strings
+        l           : the length of each string
+        alphabet    : as returned by `get_alphabet`, defaults to all symbols
+        workers     : the number of processes
+        seed        : the master seed, if None fresh entropy is used
+        backend     : passed to `EntropyPool`, use random or pcg64 for
+                      reproducible output
+        shard_size  : the number of strings per shard
+        ordered     : if False, shards are yielded as soon as they're done
+    """
+    import numpy as np
+    if seed is not None and backend not in SEEDABLE_BACKENDS:
+        raise ValueError(f"the {backend} backend can't be seeded")
+    alphabet = alphabet or get_alphabet()
+    entropy_ = np.random.SeedSequence(seed).entropy
+    def jobs():
+        for i, start in enumerate(range(0, n, shard_size)):
+            child = None
+            if backend in SEEDABLE_BACKENDS:
+                child = np.random.SeedSequence(entropy_, spawn_key=(i,))
+            yield (min(shard_size, n - start), l, alphabet, backend, child)
+    if workers <= 1:
+        yield from map(_gen_shard, jobs())
+        return
+    import multiprocessing
+    with multiprocessing.Pool(workers) as p:
+        imap = p.imap if ordered else p.imap_unordered
+        yield from imap(_gen_shard, jobs())
 
-def gen_sequence(l=args.len):
-    rands = [random.randrange(0,len(syms)) for x in range(0,l)]
-    return "".join([syms[x] for x in rands])
+def encode_batch(raw, l, alphabet=None):
+    """
+    turns a packed buffer of strings of length `l` into an (n, l) array of
+    symbol indices, the input expected by `randtests`
+    """
+    import numpy as np
+    sym_index = get_tables(alphabet or get_alphabet())[1]
+    return sym_index[np.frombuffer(raw, dtype=np.uint8)].reshape(-1, l)
 
-def calculate_divergence(strings):
+def calculate_divergence(strings, alphabet=None):
+    import numpy as np
+    from scipy.stats import entropy
+    uniform_dist = get_tables(alphabet or get_alphabet())[2]
     observed = []
     for s in strings:
         for _ in s:
@@ -51,35 +288,248 @@ def calculate_divergence(strings):
     divergence  = entropy(observed_dist, uniform_dist)
     return divergence
 
+class DivergenceMonitor:
+    """
+    keeps a fixed size count vector indexed by symbol, so the kl divergence
+    against a uniform distribution can be tracked without rebuilding a Counter
 
-if __name__ == "__main__":
-    if args.continuous:
-        i = 0
-        all_strings = []
-        divergences = []
+    each `update` is O(len(s)) and each `divergence` is O(len(alphabet))
+
+    Args:
+        alphabet: as returned by `get_alphabet`, defaults to all symbols
+        window  : if set, only the last `window` strings are counted
+        decay   : if set, each string is weighted by decay**age, where age is
+                  the number of strings seen since. overrides `window`
+    """
+    def __init__(self, alphabet=None, window=None, decay=None):
+        import numpy as np
+        alphabet = alphabet or get_alphabet()
+        _, self._sym_index, self._uniform_dist = get_tables(alphabet)
+        self.counts = np.zeros(len(alphabet), dtype=np.float64)
+        self.window = None if decay else window
+        self.decay = decay
+        self.n = 0
+        self._recent = deque()
+        self._weight = 1.0
+
+    def update(self, s):
+        import numpy as np
+        idx = self._sym_index[np.frombuffer(s.encode("ascii"), dtype=np.uint8)]
+        idx = idx[idx >= 0]
+        if self.decay:
+            # rather than multiplying every count by `decay` on each update,
+            # new observations get a growing weight - the ratios are the same
+            self._weight /= self.decay
+            if self._weight > 1e100:
+                self.counts /= self._weight
+                self._weight = 1.0
+        np.add.at(self.counts, idx, self._weight)
+        if self.window:
+            self._recent.append(idx)
+            if len(self._recent) > self.window:
+                np.subtract.at(self.counts, self._recent.popleft(), 1.0)
+        self.n += 1
+
+    def divergence(self):
+        from scipy.stats import entropy
+        return entropy(self.counts, self._uniform_dist)
+
+class PasswordGenerator:
+    """
+    an importable generator, with no argparse or other import time side effects
+
+    the alphabet for each configuration is computed once and shared between
+    generators (see `get_alphabet`), each generator owns its `EntropyPool`
+
+    example
+
+    gen = PasswordGenerator(length=32, readable=True, backend="secrets")
+    token = gen.generate()
+    tokens = gen.batch(1000)
+
+    Args:
+        length      : the default length of generated strings
+        readable    : drop the `ambiguous` symbols
+        alpha       : drop the `punc` symbols
+        symbols     : if set, start from these symbols instead of `all_syms`
+        backend     : one of random, secrets, urandom, pcg64
+        seed        : seeds the random and pcg64 backends
+    """
+    def __init__(self, length=20, readable=False, alpha=False, symbols=None,
+                 backend="random", seed=None):
+        self.length = length
+        self.alphabet = get_alphabet(readable, alpha, symbols)
+        self.backend = backend
+        self.seed = seed
+        self.pool = EntropyPool(self.alphabet, backend, seed=seed)
+
+    @property
+    def symbols(self):
+        return self.alphabet.decode("ascii")
+
+    def generate(self, l=None):
+        return gen_sequence(l or self.length, pool=self.pool)
+
+    def batch(self, n, l=None, packed=False, sep=""):
+        return gen_batch(n, l or self.length, packed=packed, sep=sep, pool=self.pool)
+
+    def write(self, n, l=None, out=None):
+        write_batch(n, l or self.length, out=out, pool=self.pool)
+
+    def sharded(self, n, l=None, workers=1, shard_size=100000, ordered=True):
+        """see `gen_sharded`, seeded from this generator's seed"""
+        return gen_sharded(
+            n,
+            l or self.length,
+            alphabet=self.alphabet,
+            workers=workers,
+            seed=self.seed,
+            backend=self.backend,
+            shard_size=shard_size,
+            ordered=ordered,
+        )
+
+    def encode(self, raw, l=None):
+        return encode_batch(raw, l or self.length, self.alphabet)
+
+    def monitor(self, window=None, decay=None):
+        return DivergenceMonitor(self.alphabet, window=window, decay=decay)
+
+    def audit(self, n=100000, l=None):
+        """runs `randtests.battery` over `n` fresh strings"""
+        import randtests
+        l = l or self.length
+        sample = self.encode(self.batch(n, l, packed=True), l)
+        return randtests.battery(sample, len(self.alphabet))
+
+class TokenBucket:
+    """
+    a token bucket rate limiter, `rate` tokens per second with bursts of up
+    to `burst` tokens. a rate of 0 (or None) disables limiting
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate or 0)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    async def acquire(self, n=1):
+        import asyncio
+        if not self.rate:
+            return
         while True:
-            size = random.randrange(25,100)
-            delay = random.random()
-            s = gen_sequence(l=size)
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= n:
+                self._tokens -= n
+                return
+            await asyncio.sleep((n - self._tokens) / self.rate)
+
+async def produce(queue, bucket, generator, batch=100):
+    """generates strings as fast as `bucket` allows, queueing them in batches"""
+    import asyncio
+    while True:
+        strings = []
+        for _ in range(batch):
+            await bucket.acquire()
+            s = generator.generate(random.randrange(25, 100))
             print(s)
-            time.sleep(delay)
-            all_strings.append(s)
-            i += 1
-            if i % 100 == 0:
-                div = calculate_divergence(all_strings)
-                print(f"the kl divergence is {div}")
-                divergences.append(div)
-                if len(divergences) >= 5:
-                    avg_divergence = np.mean(divergences)
-                    stddev_divergence = np.std(divergences)
-                    diff =  abs(div - avg_divergence) 
-                    if diff >=  3 * stddev_divergence:
-                        print(f"non randomness detected under a gaussian distribution assumption")
-                        print(f"observed kl_divergence: {diff}, 3sig: {3 * stddev_divergence}")
-                        time.sleep(5)
-                    else:
-                        divergences.append(div)
-                all_strings = []
-
-
-    print(gen_sequence())
+            strings.append(s)
+        # blocks when the monitor falls behind, and always yields so the
+        # monitor gets to run even when the bucket is unlimited
+        await queue.put(strings)
+        await asyncio.sleep(0)
+
+async def analyse(queue, monitor):
+    """
+    updates `monitor` with each batch off the queue, and flags a divergence
+    more than 3 sigma away from the recent mean
+    """
+    import asyncio
+    import numpy as np
+    divergences = deque(maxlen=1000)
+    def _update(strings):
+        for s in strings:
+            monitor.update(s)
+        return monitor.divergence()
+    while True:
+        strings = await queue.get()
+        div = await asyncio.to_thread(_update, strings)
+        queue.task_done()
+        print(f"the kl divergence is {div}")
+        if len(divergences) >= 5:
+            avg_divergence = np.mean(divergences)
+            stddev_divergence = np.std(divergences)
+            diff = abs(div - avg_divergence)
+            if diff >= 3 * stddev_divergence:
+                print(f"non randomness detected under a gaussian distribution assumption")
+                print(f"observed kl_divergence: {diff}, 3sig: {3 * stddev_divergence}")
+                continue
+        divergences.append(div)
+
+async def run_continuous(generator=None, rate=2.0, batch=100, window=100, decay=None):
+    """
+    generates strings forever at `rate` per second (0 is unlimited), while a
+    separate task tracks the kl divergence of each batch of `batch` strings
+    """
+    import asyncio
+    generator = generator or PasswordGenerator()
+    queue = asyncio.Queue(maxsize=8)
+    bucket = TokenBucket(rate)
+    monitor = generator.monitor(window=window, decay=decay)
+    await asyncio.gather(
+        produce(queue, bucket, generator, batch), analyse(queue, monitor)
+    )
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.seed is not None and args.backend not in SEEDABLE_BACKENDS:
+        parser.error(
+            f"--seed needs a seedable backend ({', '.join(SEEDABLE_BACKENDS)}), "
+            f"the {args.backend} backend isn't reproducible"
+        )
+    if args.workers is not None and args.count is None:
+        parser.error("--workers needs --count")
+    if args.count is not None and args.count < 0:
+        parser.error("--count can't be negative")
+    gen = PasswordGenerator(
+        length=args.len,
+        readable=args.readable,
+        alpha=args.alpha,
+        symbols=args.symbols,
+        backend=args.backend,
+        seed=args.seed,
+    )
+    if args.continuous:
+        import asyncio
+        asyncio.run(
+            run_continuous(gen, rate=args.rate, window=args.window, decay=args.decay)
+        )
+    elif args.audit:
+        for name, p in gen.audit(args.count or 100000).items():
+            print(f"{name:<20} p={p:.6f}" if p is not None else f"{name:<20} n/a")
+    elif args.count is not None:
+        out = open(args.output, "wb") if args.output else sys.stdout.buffer
+        workers = args.workers or 1
+        if workers > 1 or args.seed is not None:
+            for shard in gen.sharded(
+                args.count,
+                workers=workers,
+                shard_size=args.shard_size,
+                ordered=not args.unordered,
+            ):
+                out.write(shard)
+            out.flush()
+        else:
+            gen.write(args.count, out=out)
+        if args.output:
+            out.close()
+    else:
+        print(gen.generate())
+
+
+if __name__ == "__main__":
+    main()
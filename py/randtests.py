@@ -0,0 +1,113 @@
+## a battery of randomness tests over encoded samples
+##
+## every test takes `sample`, an (n, l) integer array where each row is one
+## generated string and each value is a symbol index in [0, k). everything
+## is a handful of vectorized passes (bincount / compares) over the array, so
+## millions of strings can be audited in seconds
+##
+## a test that doesn't apply to the sample, e.g. bigrams of one character
+## strings, returns None rather than a p-value
+
+import numpy as np
+from scipy.stats import chisquare, norm
+
+
+def frequency(sample, k):
+    """
+    chi-square goodness of fit of the symbol counts against uniform
+
+    Returns:
+        the p-value
+    """
+    counts = np.bincount(sample.ravel(), minlength=k)
+    return chisquare(counts).pvalue
+
+
+def bigram(sample, k):
+    """
+    chi-square goodness of fit of adjacent symbol pairs (within each string)
+    against uniform - catches symbols that follow each other too often
+
+    Returns:
+        the p-value, None if the strings are shorter than 2
+    """
+    if sample.shape[1] < 2:
+        return None
+    a = sample[:, :-1].astype(np.intp)
+    b = sample[:, 1:]
+    counts = np.bincount((a * k + b).ravel(), minlength=k * k)
+    return chisquare(counts).pvalue
+
+
+def serial_correlation(sample, k):
+    """
+    lag 1 correlation between adjacent symbol indices, under the null
+    r * sqrt(N) is ~ N(0, 1)
+
+    Returns:
+        the two sided p-value, None if there are fewer than 2 pairs or
+        either side is constant, where the correlation is undefined
+    """
+    a = sample[:, :-1].ravel().astype(np.float64)
+    b = sample[:, 1:].ravel().astype(np.float64)
+    if a.size < 2 or a.min() == a.max() or b.min() == b.max():
+        return None
+    r = np.corrcoef(a, b)[0, 1]
+    return 2 * norm.sf(abs(r) * np.sqrt(a.size))
+
+
+def runs(sample, k):
+    """
+    wald-wolfowitz runs test on the stream of symbols, split into the lower
+    and upper half of the alphabet
+
+    Returns:
+        the two sided p-value, None if either half never occurs (the
+        frequency test covers that)
+    """
+    x = sample.ravel() >= k // 2
+    n = x.size
+    n1 = np.count_nonzero(x)
+    n2 = n - n1
+    if n1 == 0 or n2 == 0:
+        return None
+    observed = 1 + np.count_nonzero(x[1:] != x[:-1])
+    mu = 2.0 * n1 * n2 / n + 1
+    var = 2.0 * n1 * n2 * (2.0 * n1 * n2 - n) / (n * n * (n - 1))
+    z = (observed - mu) / np.sqrt(var)
+    return 2 * norm.sf(abs(z))
+
+
+def positional(sample, k):
+    """
+    chi-square goodness of fit of the symbol counts at each character index
+
+    Returns:
+        an array with one p-value per position
+    """
+    n, l = sample.shape
+    codes = np.arange(l, dtype=np.intp) * k + sample
+    counts = np.bincount(codes.ravel(), minlength=l * k).reshape(l, k)
+    return chisquare(counts, axis=1).pvalue
+
+
+def battery(sample, k):
+    """
+    runs every test over `sample`
+
+    the positional test is reduced to a single bonferroni corrected p-value,
+    the smallest per position p-value times the number of positions
+
+    Returns:
+        a dict of test name -> p-value, or None if the test doesn't apply
+    """
+    sample = np.asarray(sample)
+    pos = positional(sample, k)
+    results = {
+        "frequency": frequency(sample, k),
+        "bigram": bigram(sample, k),
+        "serial_correlation": serial_correlation(sample, k),
+        "runs": runs(sample, k),
+        "positional": min(1.0, pos.min() * pos.size),
+    }
+    return {name: None if p is None else float(p) for name, p in results.items()}
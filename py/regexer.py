@@ -1,15 +1,409 @@
 ## this function helps compose complex regex strings
+##
+## run as a script, it searches large files with a composed pattern, see `main`
 
+import os
 import re
-from typing import Sequence, Union
+import sys
+import mmap
+import time
+import argparse
+import warnings
+import importlib
+import multiprocessing
+from functools import lru_cache
+import typing
 
-def cr(parts:Sequence=[], 
-       group:Union(bool,str)="", 
+try:
+    from re import _parser as _sre_parse, _constants as _sre
+except ImportError:
+    # python < 3.11
+    import sre_parse as _sre_parse, sre_constants as _sre
+
+# the number of composed strings / compiled patterns kept by `cr`
+CACHE_SIZE = 4096
+
+option_priority={
+    's'        : 100,
+    'g'        : 200,
+    'e'        : 300,
+    'g:.+'     : 400,
+    '(\*|\+)'  : 500,
+    '\?'       : 600
+}
+
+@lru_cache(maxsize=None)
+def _op(o):
+    for k,v in option_priority.items():
+        if re.match(k, o):
+            return v
+
+@lru_cache(maxsize=CACHE_SIZE)
+def options_(option_string):
+    """
+    parses an option string, e.g. 'e,s,g' into a tuple sorted by
+    `option_priority`, or None if there are no options
+    """
+    options=option_string.split(",")
+    if len(options)==1 and options[0]=="":
+        return None
+    return tuple(sorted(options, key=_op))
+
+_compile = lru_cache(maxsize=CACHE_SIZE)(re.compile)
+
+def _normalize(parts):
+    """
+    parts as a hashable tuple, list contents become tuples and a bare node
+    is the same as ('', node)
+    """
+    return tuple(
+        ("", p) if isinstance(p, Node) else
+        (p[0], tuple(p[1]) if isinstance(p[1], list) else p[1])
+        for p in parts
+    )
+
+def cache_info():
+    """hit/miss statistics for the caches behind `cr`"""
+    return {
+        "build": _build.cache_info(),
+        "options": options_.cache_info(),
+        "compile": _compile.cache_info(),
+    }
+
+def cache_clear():
+    _build.cache_clear()
+    options_.cache_clear()
+    _compile.cache_clear()
+
+def _has_alternation(text):
+    """True if `text` has a | outside of any group or set"""
+    depth=0
+    in_set=False
+    i=0
+    while i < len(text):
+        c=text[i]
+        if c=="\\":
+            i+=1
+        elif in_set:
+            if c=="]":
+                in_set=False
+        elif c=="[":
+            in_set=True
+            # a ] straight after [ or [^ is a literal
+            if text[i+1:i+2]=="]":
+                i+=1
+            elif text[i+1:i+3]=="^]":
+                i+=2
+        elif c=="(":
+            depth+=1
+        elif c==")":
+            depth-=1
+        elif c=="|" and depth==0:
+            return True
+        i+=1
+    return False
+
+
+class Node:
+    """
+    base class of the regex tree built by `cr`
+
+    nodes are immutable and hashable. the pattern is rendered, after
+    `optimize`, the first time `pattern` is read, and compiled the first
+    time `compile` is called
+    """
+    __slots__=("_pattern", "_compiled")
+
+    def __init__(self):
+        self._pattern=None
+        self._compiled=None
+
+    def _key(self):
+        raise NotImplementedError
+
+    def render(self):
+        """the pattern for this tree as is, without optimizing it"""
+        raise NotImplementedError
+
+    def optimize(self):
+        """returns an equivalent, possibly simpler, tree"""
+        return self
+
+    def alternates(self):
+        """True if the rendered pattern has a top level |"""
+        return False
+
+    def atomic(self):
+        """True if a quantifier after the rendered pattern applies to all of it"""
+        return False
+
+    @property
+    def pattern(self):
+        if self._pattern is None:
+            self._pattern=self.optimize().render()
+        return self._pattern
+
+    def compile(self):
+        if self._compiled is None:
+            self._compiled=_compile(self.pattern)
+        return self._compiled
+
+    def __str__(self):
+        return self.pattern
+
+    def __repr__(self):
+        return f"{type(self).__name__}{self._key()!r}"
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key()==other._key()
+
+    def __hash__(self):
+        return hash((type(self).__name__, self._key()))
+
+    def __add__(self, other):
+        return Sequence((self, other))
+
+
+class Literal(Node):
+    """text matched literally, it's escaped when rendered"""
+    __slots__=("text",)
+
+    def __init__(self, text):
+        super().__init__()
+        self.text=text
+
+    def _key(self):
+        return (self.text,)
+
+    def render(self):
+        return re.escape(self.text)
+
+    def atomic(self):
+        return len(self.text)==1
+
+
+class Raw(Node):
+    """a regular expression string, rendered as is"""
+    __slots__=("text",)
+
+    def __init__(self, text):
+        super().__init__()
+        self.text=text
+
+    def _key(self):
+        return (self.text,)
+
+    def render(self):
+        return self.text
+
+    def alternates(self):
+        return _has_alternation(self.text)
+
+
+class Set(Node):
+    """[child]"""
+    __slots__=("child",)
+
+    def __init__(self, child):
+        super().__init__()
+        self.child=child
+
+    def _key(self):
+        return (self.child,)
+
+    def render(self):
+        return f"[{self.child.render()}]"
+
+    def optimize(self):
+        return Set(self.child.optimize())
+
+    def atomic(self):
+        return True
+
+
+class Group(Node):
+    """(child), or (?:child) if capture is False"""
+    __slots__=("child", "capture")
+
+    def __init__(self, child, capture=True):
+        super().__init__()
+        self.child=child
+        self.capture=capture
+
+    def _key(self):
+        return (self.child, self.capture)
+
+    def render(self):
+        if self.capture:
+            return f"({self.child.render()})"
+        return f"(?:{self.child.render()})"
+
+    def optimize(self):
+        child=self.child.optimize()
+        if not self.capture and child.atomic():
+            # (?:(a)) and (?:[ab]) are (a) and [ab]
+            return child
+        return Group(child, self.capture)
+
+    def atomic(self):
+        return True
+
+
+class NamedGroup(Node):
+    """(?P<name>child)"""
+    __slots__=("name", "child")
+
+    def __init__(self, name, child):
+        super().__init__()
+        self.name=name
+        self.child=child
+
+    def _key(self):
+        return (self.name, self.child)
+
+    def render(self):
+        return f"(?P<{self.name}>{self.child.render()})"
+
+    def optimize(self):
+        return NamedGroup(self.name, self.child.optimize())
+
+    def atomic(self):
+        return True
+
+
+class Repeat(Node):
+    """
+    child* or child+
+
+    like `cr`, the quantifier is appended to the rendered child, so it only
+    applies to all of it if the child is atomic
+    """
+    __slots__=("child", "op")
+
+    def __init__(self, child, op="*"):
+        super().__init__()
+        self.child=child
+        self.op=op
+
+    def _key(self):
+        return (self.child, self.op)
+
+    def render(self):
+        return f"{self.child.render()}{self.op}"
+
+    def optimize(self):
+        return type(self)(self._optimize_child(), self.op)
+
+    def _optimize_child(self):
+        child=self.child.optimize()
+        if self.child.atomic() and not child.atomic():
+            # e.g. a flattened (?:ab) - the quantifier needs the group back
+            child=Group(child, capture=False)
+        return child
+
+    def alternates(self):
+        return self.child.alternates()
+
+
+class Optional(Repeat):
+    """child?"""
+    __slots__=()
+
+    def __init__(self, child, op="?"):
+        super().__init__(child, op)
+
+    def optimize(self):
+        return Optional(self._optimize_child())
+
+
+class Sequence(Node):
+    """the children, one after another"""
+    __slots__=("children",)
+
+    def __init__(self, children):
+        super().__init__()
+        self.children=tuple(children)
+
+    def _key(self):
+        return self.children
+
+    def render(self):
+        return "".join(c.render() for c in self.children)
+
+    def alternates(self):
+        return any(c.alternates() for c in self.children)
+
+    def atomic(self):
+        return len(self.children)==1 and self.children[0].atomic()
+
+    def optimize(self):
+        """
+        flattens nested sequences and non capturing groups that don't
+        alternate, and merges adjacent literal / raw text
+        """
+        out=[]
+        children=[c.optimize() for c in self.children]
+        for n, c in enumerate(children):
+            # raw text such as "+" after the group would quantify only the
+            # last item of its flattened content
+            quantified=(
+                n+1 < len(children)
+                and isinstance(children[n+1], Raw)
+                and children[n+1].text[:1] in ("*", "+", "?", "{")
+            )
+            if isinstance(c, Sequence):
+                items=c.children
+            elif (isinstance(c, Group) and not c.capture and not c.child.alternates()
+                  and not (quantified and not c.child.atomic())):
+                child=c.child
+                items=child.children if isinstance(child, Sequence) else (child,)
+            else:
+                items=(c,)
+            for i in items:
+                if out and isinstance(i, (Literal, Raw)) and isinstance(out[-1], (Literal, Raw)):
+                    prev=out[-1]
+                    if isinstance(prev, Literal) and isinstance(i, Literal):
+                        out[-1]=Literal(prev.text+i.text)
+                    else:
+                        out[-1]=Raw(prev.render()+i.render())
+                else:
+                    out.append(i)
+        if len(out)==1:
+            return out[0]
+        return Sequence(out)
+
+
+
+class Alternation(Node):
+    """child1|child2|..., usually wrapped in a non capturing `Group`"""
+    __slots__=("children",)
+
+    def __init__(self, children):
+        super().__init__()
+        self.children=tuple(children)
+
+    def _key(self):
+        return self.children
+
+    def render(self):
+        return "|".join(c.render() for c in self.children)
+
+    def optimize(self):
+        return Alternation(c.optimize() for c in self.children)
+
+    def alternates(self):
+        return len(self.children) > 1
+
+
+def cr(parts:typing.Sequence=[], 
+       group:typing.Union[bool,str]="", 
        is_set:bool=False,
        zom:bool=False,
        oom:bool=False,
        optional:bool=False,
-       compile:bool=False)->str:
+       compile:bool=False,
+       node:bool=False,
+       lint:bool=False)->str:
     """
     convenience for building a `complex` regex string
     each part is a 2-tuple:
@@ -46,11 +440,22 @@ def cr(parts:Sequence=[],
         oom         : if True, append a +
         optional    : if True, append a ?
         compile     : if True, compile the expression before returning
+        node        : if True, return the `Node` tree instead of a string
+        lint        : if True, run `check` on the result, which warns about
+                      patterns prone to catastrophic backtracking
 
     this function may seem like overkill, but it's useful when reusing 
     multiple expressions within expressions, as the output of `cr` can be used 
     as a part in another higher level regular expression
 
+    the output is cached on the normalized arguments (see `cache_info`), so
+    reusing the same sub-parts across a large grammar builds and compiles
+    each of them once
+
+    internally `cr` builds a tree of `Node`s, which is returned with
+    node=True. a node can be used as the content of a part, which keeps the
+    whole pattern as one tree so it can be optimized before it's rendered
+
     if you've ever worked on very long regular expressions, you can most
     likely attest to the amazing amount of frustration caused by
     unmatched parentheses or a misplaced */? breaking the entire sequence.
@@ -81,91 +486,783 @@ def cr(parts:Sequence=[],
         group="mycomplexregex"
     )
     """
-    r_string=""
-    option_priority={
-        's'        : 100,
-        'g'        : 200,
-        'e'        : 300,
-        'g:.+'     : 400,
-        '(\*|\+)'  : 500,
-        '\?'       : 600
-    }
-    def _op(o):
-        for k,v in option_priority.items():
-            if re.match(k, o):
-                return v
-    def _group(name="", r_string=""):
-        _ = "" 
-        if name:
-            _=f"(?P<{name}>{r_string})"
-        else:
-            _+=f"({r_string})"
-        return _
-
-    def options_(option_string):
-        options=option_string.split(",")
-        if len(options)==1 and options[0]=="":
-            options=None
-            return options
-        else:
-            return sorted(options, key=_op)
-    
+    node_ = _build(_normalize(parts), group, is_set, zom, oom, optional)
+    if lint:
+        check(node_)
+    if node:
+        return node_
+    if compile:
+        return node_.compile()
+    return node_.pattern
+
+def _content(content, escape=False):
+    """a part's content as a node"""
+    if isinstance(content, Node):
+        return Literal(content.pattern) if escape else content
+    if type(content)==tuple:
+        content="".join(x for x in content)
+    return Literal(content) if escape else Raw(content)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _build(parts, group, is_set, zom, oom, optional):
+    """
+    builds the node tree for `cr`
+
+    precendence of operations
+    e s g, *+?
+    """
+    nodes=[]
     for p in parts:
-        # begin processing all parts
-        s_string=""
         options=options_(p[0])
         if not options:
-            if type(p[1])==str:
-                s_string=p[1]
-            elif type(p[1])==list:
-                s_string="".join([x for x in p[1]])
-            r_string+=s_string
-            next
-        else    :   
-            """
-            precendence of operations
-            e s g, *+?
-            """
-            # first, compress the string and escape it
-            if 'e' in options:
-                if type(p[1])==str: 
-                    s_string+=re.escape(p[1])
-                elif type(p[1])==list:
-                    s_string+=re.escape("".join(x for x in p[1]))
-                    del options[options.index("e")]
-            else:
-                if type(p[1])==str: 
-                    s_string+=p[1]
-                elif type(p[1])==list:
-                    s_string+="".join(x for x in p[1])
-            for o in options:
-                if o=="s":
-                    s_string=f"[{s_string}]"
-                if o=="g":
-                    s_string=_group(name="", r_string=s_string)
-                if re.match("g:.+",o):
-                    name = o.split(":")[1]
-                    s_string=_group(name=name, r_string=s_string)
-                if o in ["*", "+"]:
-                    s_string=f"{s_string}{o}"
-        # end parts - Append the 'part'
-            r_string+=s_string
+            nodes.append(_content(p[1]))
+            continue
+        # first, compress the string and escape it
+        node_=_content(p[1], escape='e' in options)
+        for o in options:
+            if o=="s":
+                node_=Set(node_)
+            if o=="g":
+                node_=Group(node_)
+            if re.match("g:.+",o):
+                node_=NamedGroup(o.split(":")[1], node_)
+            if o in ["*", "+"]:
+                node_=Repeat(node_, o)
+        nodes.append(node_)
+    node_=Sequence(nodes)
     if is_set:
-            r_string=f"[{r_string}]"    
+        node_=Set(node_)
     if group:
         if type(group)==bool:
-            r_string=_group("", r_string)
+            node_=Group(node_)
         elif type(group)==str:
-            r_string=_group(group, r_string)
+            node_=NamedGroup(group, node_)
     if zom:
-        r_string=f"{r_string}*"
+        node_=Repeat(node_, "*")
     if oom:
-        r_string=f"{r_string}+"
+        node_=Repeat(node_, "+")
     if optional:
-        r_string=f"{r_string}?"
+        node_=Optional(node_)
+    return node_
+
+
+def _insert(trie, literal):
+    for c in literal:
+        trie=trie.setdefault(c, {})
+    trie[""]={}
+
+def _trie_node(trie):
+    """the node matching every literal in `trie`, longest first"""
+    branches=[]
+    for c, sub in sorted((c, sub) for c, sub in trie.items() if c!=""):
+        # follow single child chains, so the depth is the number of branch
+        # points rather than the length of the literals
+        text=c
+        while len(sub)==1 and "" not in sub:
+            (c, sub),=sub.items()
+            text+=c
+        if list(sub)==[""]:
+            branches.append(Literal(text))
+        else:
+            branches.append(Sequence((Literal(text), _trie_node(sub))))
+    if not branches:
+        # only the empty string, or no literals at all, which must never
+        # match rather than match everywhere
+        return Literal("") if "" in trie else Raw("(?!)")
+    if len(branches) > 1 and all(isinstance(b, Literal) and b.atomic() for b in branches):
+        node_=Set(Raw("".join(b.render() for b in branches)))
+    elif len(branches)==1:
+        node_=branches[0]
+    else:
+        node_=Group(Alternation(branches), capture=False)
+    if "" in trie:
+        if not node_.atomic():
+            node_=Group(node_, capture=False)
+        node_=Optional(node_)
+    return node_
+
+def trie(literals:typing.Iterable[str],
+         group:typing.Union[bool,str]="",
+         compile:bool=False,
+         node:bool=False)->str:
+    """
+    builds an alternation over `literals`, factored into a prefix trie
+
+        ["foobar", "foobaz", "foo", "qux"] -> (?:foo(?:ba[rz])?|qux)
+
+    python's re tries each branch of a flat a|b|c in turn, so matching a
+    join of thousands of literals costs time in the number of literals.
+    factored, each character of the input is compared against at most one
+    branch per trie level, so the cost depends on the length of the input
+
+    where one literal is a prefix of another, the longest one matches,
+    the same as a naive join sorted longest first. with no literals the
+    pattern never matches
+
+    Args:
+        literals    : the strings to match, escaped when rendered
+        group       : as in `cr`
+        compile     : if True, compile the expression before returning
+        node        : if True, return the `Node` tree instead of a string
+    """
+    root={}
+    for l in literals:
+        _insert(root, l)
+    node_=_trie_node(root)
+    if group:
+        if type(group)==bool:
+            node_=Group(node_)
+        elif type(group)==str:
+            node_=NamedGroup(group, node_)
+    if node:
+        return node_
     if compile:
-        return re.compile(r_string)
-    else: 
-        return r_string
+        return node_.compile()
+    return node_.pattern
+
+
+def _group_refs(items):
+    """the number of numbered references (backreferences and (?(N)...)) in a parsed pattern"""
+    n=0
+    for op, av in items:
+        if op in (_sre.GROUPREF, _sre.GROUPREF_EXISTS):
+            n+=1
+        for a in (av if isinstance(av, (tuple, list)) else (av,)):
+            if isinstance(a, _sre_parse.SubPattern):
+                n+=_group_refs(a)
+            elif isinstance(a, (tuple, list)):
+                n+=sum(_group_refs(x) for x in a if isinstance(x, _sre_parse.SubPattern))
+    return n
+
+def _renumber_groups(pattern, offset):
+    """
+    shifts the numbered backreferences (\\N) and conditionals ((?(N)...)) of
+    `pattern` by `offset`, for a pattern moved `offset` groups to the right.
+    named references are left alone
+
+    Raises:
+        ValueError: if a reference would go past \\99, the highest a pattern
+        can refer to by number, or the references couldn't all be found
+    """
+    if not offset:
+        return pattern
+    out=[]
+    i=0
+    n=len(pattern)
+    in_class=False
+    renumbered=0
+    named=0
+    while i < n:
+        c=pattern[i]
+        if c=="\\" and i+1 < n:
+            m=None if in_class else re.match(r"[1-9][0-9]?", pattern[i+1:i+3])
+            if m and not re.match(r"[0-7]{3}", pattern[i+1:i+4]):
+                number=int(m.group())+offset
+                if number > 99:
+                    raise ValueError(f"can't renumber the backreference \\{m.group()} of {pattern!r} past \\99")
+                out.append(f"\\{number}")
+                i+=1+len(m.group())
+                renumbered+=1
+                continue
+            out.append(pattern[i:i+2])
+            i+=2
+            continue
+        if in_class:
+            if c=="]":
+                in_class=False
+        elif c=="[":
+            in_class=True
+            # a ] first in the class is a literal
+            j=i+1+(pattern[i+1:i+2]=="^")
+            if pattern[j:j+1]=="]":
+                out.append(pattern[i:j+1])
+                i=j+1
+                continue
+        else:
+            m=re.match(r"\(\?(?:\(([0-9]+)\)|P=\w+\)|\(\w+\))", pattern[i:])
+            if m and m.group(1):
+                out.append(f"(?({int(m.group(1))+offset})")
+                i+=m.end()
+                renumbered+=1
+                continue
+            if m:
+                named+=1
+        out.append(c)
+        i+=1
+    if renumbered+named!=_group_refs(_sre_parse.parse(_locale_bytes(pattern))):
+        raise ValueError(f"couldn't renumber the group references of {pattern!r}, use named groups")
+    return "".join(out)
+
+_global_flags=re.compile(r"\(\?([aiLmsux]+)\)")
+_flag_letters=(
+    (re.ASCII, "a"), (re.IGNORECASE, "i"), (re.LOCALE, "L"),
+    (re.MULTILINE, "m"), (re.DOTALL, "s"), (re.VERBOSE, "x"),
+)
+
+def _locale_bytes(pattern):
+    """
+    `pattern` encoded as latin-1 if it's scoped by `_scope_flags` with the L
+    flag, which only bytes patterns allow, else `pattern`
+    """
+    # the scoped flags are in the order a, i, L
+    if re.match(r"\(\?a?i?L", pattern):
+        return pattern.encode("latin-1")
+    return pattern
+
+def _scope_flags(pattern, flags=0):
+    """
+    moves the global inline flags at the start of `pattern`, e.g. (?i), and
+    `flags` (e.g. those of a compiled pattern) into a group scoped to it, so
+    it can be embedded in a larger pattern: (?i)abc -> (?i:abc)
+
+    u is dropped, it's the default for str patterns and not allowed in
+    bytes ones
+    """
+    letters=""
+    m=_global_flags.match(pattern)
+    while m:
+        letters+=m.group(1)
+        pattern=pattern[m.end():]
+        m=_global_flags.match(pattern)
+    letters="".join(c for f, c in _flag_letters if c in letters or flags & f)
+    if not letters:
+        return pattern
+    # a trailing verbose comment would swallow the closing paren
+    end="\n)" if "x" in letters else ")"
+    return f"(?{letters}:{pattern}{end}"
+
+class Scanner:
+    """
+    merges named patterns into one compiled alternation, so a buffer is
+    scanned once instead of once per pattern
+
+        scanner = Scanner({"atom": patterns["atom"], "flag": cr([...])})
+        for name, span, groups in scanner.scan(text):
+            ...
+
+    matches don't overlap - at each position the first pattern (in the order
+    given) that matches wins, and scanning resumes where that match ended.
+    each pattern is wrapped in a named group, so names must be identifiers
+    and group names inside the patterns must be unique across all of them.
+    numbered backreferences (\\1) and conditionals ((?(1)...)) are
+    renumbered to the pattern's groups in the merged pattern, which fails
+    with a ValueError past \\99 - use named groups for those
+
+    each pattern's flags, inline ((?i)...) or those of a compiled pattern,
+    are scoped to it. a pattern with the L flag can only scan bytes
+
+    Args:
+        patterns    : a dict of name -> pattern, as a string, a `Node` or a
+                      compiled pattern
+        flags       : re flags for the combined pattern
+    """
+    def __init__(self, patterns, flags=0):
+        parts=[]
+        # index of the outer group -> (name, number of groups inside it)
+        self._groups={}
+        index=1
+        locale=flags & re.LOCALE
+        for name, p in patterns.items():
+            if not name.isidentifier():
+                raise ValueError(f"scanner pattern names must be identifiers, got {name!r}")
+            p_flags=0
+            if isinstance(p, re.Pattern):
+                p_flags=p.flags
+                p=p.pattern
+            elif isinstance(p, Node):
+                p=p.pattern
+            if isinstance(p, bytes):
+                p=p.decode("latin-1")
+            p=_scope_flags(p, p_flags)
+            locale=locale or isinstance(_locale_bytes(p), bytes)
+            inner=_compile(_locale_bytes(p)).groups
+            # the pattern's group 1 is group index+1 of the merged pattern
+            p=_renumber_groups(p, index)
+            parts.append(f"(?P<{name}>{p})")
+            self._groups[index]=(name, inner)
+            index+=1+inner
+        self.pattern="|".join(parts)
+        self.flags=flags
+        self._regex=None
+        self._bytes_regex=None
+        # compile now, so a bad pattern fails here rather than in `scan`
+        if locale:
+            self._regex_for(b"")
+        else:
+            self.regex
+
+    @property
+    def regex(self):
+        """the combined pattern, compiled for str buffers"""
+        if self._regex is None:
+            self._regex=_compile(self.pattern, self.flags)
+        return self._regex
+
+    def _regex_for(self, buffer):
+        if isinstance(buffer, str):
+            return self.regex
+        if self._bytes_regex is None:
+            self._bytes_regex=_compile(self.pattern.encode("latin-1"), self.flags)
+        return self._bytes_regex
+
+    def scan(self, buffer, pos=0, endpos=None):
+        """
+        makes one pass over `buffer` (str, bytes or any buffer such as an
+        mmap) and yields a (name, span, groups) event per match, where groups
+        are the pattern's own groups, as in `match.groups()`
+        """
+        regex=self._regex_for(buffer)
+        endpos=len(buffer) if endpos is None else endpos
+        for m in regex.finditer(buffer, pos, endpos):
+            name, inner=self._groups[m.lastindex]
+            # m.groups()[i] is group i+1, the pattern's groups follow its own
+            yield name, m.span(), m.groups()[m.lastindex:m.lastindex+inner]
+
+
+
+## performance linting
+##
+## `lint` walks the parsed pattern looking for the shapes behind catastrophic
+## backtracking, `fuzz` times the pattern against inputs built to trigger it
+
+class RegexPerformanceWarning(UserWarning):
+    pass
+
+# character classes are approximated over the first 256 code points
+_UNIVERSE=frozenset(range(256))
+
+@lru_cache(maxsize=None)
+def _category(category):
+    """the code points in _UNIVERSE matched by a \\d, \\w, ... category"""
+    regex={
+        "CATEGORY_DIGIT": r"\d", "CATEGORY_NOT_DIGIT": r"\D",
+        "CATEGORY_SPACE": r"\s", "CATEGORY_NOT_SPACE": r"\S",
+        "CATEGORY_WORD": r"\w", "CATEGORY_NOT_WORD": r"\W",
+    }.get(str(category))
+    if regex is None:
+        return _UNIVERSE
+    regex=re.compile(regex)
+    return frozenset(c for c in _UNIVERSE if regex.match(chr(c)))
+
+def _charset(items):
+    """the code points matched by the contents of an IN item"""
+    chars=set()
+    negate=False
+    for op, av in items:
+        if op is _sre.NEGATE:
+            negate=True
+        elif op is _sre.LITERAL:
+            chars.add(av)
+        elif op is _sre.RANGE:
+            chars.update(range(av[0], min(av[1], 255)+1))
+        elif op is _sre.CATEGORY:
+            chars|=_category(av)
+        else:
+            chars|=_UNIVERSE
+    return _UNIVERSE-chars if negate else frozenset(chars)
+
+def _unbounded(op, av):
+    return op in (_sre.MAX_REPEAT, _sre.MIN_REPEAT) and av[1]==_sre.MAXREPEAT
+
+def _first(items):
+    """
+    (the code points the sequence of parsed items can start with, and True
+    if the sequence can match the empty string)
+    """
+    first=set()
+    for op, av in items:
+        nullable=False
+        if op is _sre.LITERAL:
+            first.add(av)
+        elif op is _sre.NOT_LITERAL:
+            first|=_UNIVERSE-{av}
+        elif op is _sre.ANY:
+            first|=_UNIVERSE
+        elif op is _sre.IN:
+            first|=_charset(av)
+        elif op is _sre.SUBPATTERN:
+            f, nullable=_first(av[-1])
+            first|=f
+        elif op is getattr(_sre, "ATOMIC_GROUP", None):
+            f, nullable=_first(av)
+            first|=f
+        elif op in (_sre.MAX_REPEAT, _sre.MIN_REPEAT) or op is getattr(_sre, "POSSESSIVE_REPEAT", None):
+            f, nullable=_first(av[2])
+            first|=f
+            nullable=nullable or av[0]==0
+        elif op is _sre.BRANCH:
+            for alt in av[1]:
+                f, n=_first(alt)
+                first|=f
+                nullable=nullable or n
+        elif op in (_sre.AT, _sre.ASSERT, _sre.ASSERT_NOT):
+            # zero width
+            nullable=True
+        else:
+            # back references and the like could be anything
+            first|=_UNIVERSE
+            nullable=True
+        if not nullable:
+            return frozenset(first), False
+    return frozenset(first), True
+
+def _show(chars):
+    """a short description of a set of code points"""
+    if chars==_UNIVERSE:
+        return "any character"
+    shown="".join(chr(c) for c in sorted(chars) if 32 < c < 127)[:12]
+    return f"[{shown}{'...' if len(chars) > len(shown) else ''}]"
+
+def _where(group):
+    return f"in group {group}" if group else "at the top level"
+
+def _walk(items, follow, loops, group, findings):
+    """
+    walks a parsed sequence
+
+    Args:
+        follow      : the code points that can come after the sequence
+        loops       : the number of unbounded repeats the sequence is in
+        group       : the innermost group, to say where a finding is
+        findings    : the list findings are added to
+    """
+    items=list(items)
+    for i, (op, av) in enumerate(items):
+        rest, nullable=_first(items[i+1:])
+        after=rest|follow if nullable else rest
+        if op is _sre.SUBPATTERN:
+            name=av[0] if av[0] else group
+            _walk(av[-1], after, loops, name, findings)
+        elif op in (_sre.MAX_REPEAT, _sre.MIN_REPEAT):
+            body=av[2]
+            if _unbounded(op, av):
+                first, _=_first(body)
+                inner_follow=first|after
+                overlap=first & after
+                if loops and overlap:
+                    findings.append((
+                        "nested-quantifier",
+                        f"an unbounded repeat inside another unbounded repeat can "
+                        f"match {_show(overlap)} either way ({_where(group)})",
+                    ))
+                _walk(body, inner_follow, loops+1, group, findings)
+            else:
+                _walk(body, after, loops, group, findings)
+        elif op is _sre.BRANCH:
+            alts=av[1]
+            if loops:
+                firsts=[_first(a)[0] for a in alts]
+                for a in range(len(firsts)):
+                    for b in range(a+1, len(firsts)):
+                        overlap=firsts[a] & firsts[b]
+                        if overlap:
+                            findings.append((
+                                "overlapping-alternation",
+                                f"alternatives {a+1} and {b+1} inside an unbounded repeat "
+                                f"can both start with {_show(overlap)} ({_where(group)})",
+                            ))
+            for alt in alts:
+                _walk(alt, after, loops, group, findings)
+        elif op in (_sre.ASSERT, _sre.ASSERT_NOT):
+            _walk(av[1], _UNIVERSE, loops, group, findings)
+        # possessive repeats and atomic groups never backtrack into, skip them
+
+def lint(pattern, flags=0):
+    """
+    statically checks a pattern for catastrophic backtracking
+
+    flags
+        nested-quantifier       : an unbounded repeat inside another, where
+                                  the inner one can end or go round again on
+                                  the same character, e.g. (a+)+ or (\\w+\\s?)*
+        overlapping-alternation : a branch inside an unbounded repeat whose
+                                  alternatives can start with the same
+                                  character, e.g. (\\w|\\d)+
+
+    character classes are approximated over latin-1
+
+    Args:
+        pattern     : a string, `Node` or compiled pattern
+        flags       : re flags, if pattern is a string
+
+    Returns:
+        a list of (kind, message)
+    """
+    if isinstance(pattern, re.Pattern):
+        pattern, flags=pattern.pattern, pattern.flags
+    if isinstance(pattern, Node):
+        pattern=pattern.pattern
+    if isinstance(pattern, bytes):
+        pattern=pattern.decode("latin-1")
+    findings=[]
+    _walk(_sre_parse.parse(pattern, flags), frozenset(), 0, 0, findings)
+    return findings
+
+def _adversarial(pattern, flags, sizes):
+    """
+    inputs that pump each repeated character class of the pattern, followed
+    by a character that's unlikely to let the match finish
+    """
+    parsed=_sre_parse.parse(pattern, flags)
+    pumps=set()
+    def collect(items):
+        for op, av in items:
+            if op in (_sre.MAX_REPEAT, _sre.MIN_REPEAT):
+                first, _=_first(av[2])
+                if first:
+                    chars=sorted(first)
+                    pumps.add(chr(chars[0]))
+                    pumps.add(chr(chars[0])+chr(chars[-1]))
+                collect(av[2])
+            elif op is _sre.SUBPATTERN:
+                collect(av[-1])
+            elif op is _sre.BRANCH:
+                for alt in av[1]:
+                    collect(alt)
+    collect(parsed)
+    used, _=_first(parsed)
+    tails=[chr(c) for c in (0, 33, 10) if c not in used][:1] or ["\x00"]
+    for pump in sorted(pumps):
+        for n in sizes:
+            yield (pump*n)[:n]+tails[0]
+
+def _time_searches(pattern, flags, inputs, results):
+    regex=re.compile(pattern, flags)
+    for s in inputs:
+        start=time.perf_counter()
+        regex.search(s)
+        results.put((len(s), repr(s[:8]), time.perf_counter()-start))
+    results.put(None)
+
+def fuzz(pattern, flags=0, timeout=1.0, sizes=(16, 64, 256, 1024, 4096)):
+    """
+    times the pattern against adversarial inputs in a separate process,
+    which is killed if a search takes longer than `timeout` seconds
+
+    Args:
+        pattern     : a string, `Node` or compiled pattern
+        flags       : re flags, if pattern is a string
+        timeout     : the budget for any one search
+        sizes       : the input lengths
+
+    Returns:
+        a list of (kind, message), empty if every search was fast
+    """
+    if isinstance(pattern, re.Pattern):
+        pattern, flags=pattern.pattern, pattern.flags
+    if isinstance(pattern, Node):
+        pattern=pattern.pattern
+    inputs=list(_adversarial(pattern, flags, sizes))
+    results=multiprocessing.Queue()
+    p=multiprocessing.Process(target=_time_searches, args=(pattern, flags, inputs, results))
+    p.start()
+    findings=[]
+    done=0
+    try:
+        while done < len(inputs):
+            try:
+                r=results.get(timeout=timeout)
+            except Exception:
+                size=len(inputs[done])
+                findings.append((
+                    "timeout",
+                    f"search of a {size} character input {inputs[done][:8]!r}... "
+                    f"took longer than {timeout}s",
+                ))
+                break
+            if r is None:
+                break
+            size, head, elapsed=r
+            if elapsed > timeout/10:
+                findings.append((
+                    "slow",
+                    f"search of a {size} character input {head}... took {elapsed:.3f}s",
+                ))
+            done+=1
+    finally:
+        p.terminate()
+        p.join()
+    return findings
+
+def check(pattern, flags=0, fuzz_=False, timeout=1.0):
+    """
+    runs `lint`, and optionally `fuzz`, and raises a RegexPerformanceWarning
+    per finding - use warnings.simplefilter("error", RegexPerformanceWarning)
+    to fail a build on them
+
+    Returns:
+        the findings
+    """
+    findings=lint(pattern, flags)
+    if fuzz_:
+        findings+=fuzz(pattern, flags, timeout)
+    for kind, message in findings:
+        warnings.warn(f"{kind}: {message}", RegexPerformanceWarning, stacklevel=2)
+    return findings
+
+def _file_chunks(path, chunk_size):
+    """
+    (start, end) byte offsets covering the file, each chunk ends just after a
+    newline (or at the end of the file), so line oriented matches aren't cut
+    """
+    size=os.path.getsize(path)
+    if not size:
+        return
+    with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start=0
+        while start < size:
+            end=min(start+chunk_size, size)
+            if end < size:
+                nl=mm.find(b"\n", end)
+                end=size if nl==-1 else nl+1
+            yield start, end
+            start=end
+
+def _grep_chunk(task):
+    """
+    searches one chunk of a memory mapped file
+
+    the search runs up to `overlap` bytes past the end of the chunk, but only
+    matches starting inside the chunk are kept. `grep` drops (and rescans
+    past) what a match crossing into the next chunk overlaps there
+    """
+    path, start, end, overlap, pattern, flags=task
+    regex=_compile(pattern, flags)
+    matches=[]
+    with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for m in regex.finditer(mm, start, min(end+overlap, len(mm))):
+            if m.start() >= end:
+                break
+            matches.append((m.start(), m.group()))
+    return path, start, end, matches
+
+def load_pattern(spec):
+    """
+    loads a pattern from `module:attribute`, where the attribute is a
+    string, a `Node` or a compiled pattern, e.g. one built with `cr`
+    """
+    module, _, attr=spec.partition(":")
+    obj=importlib.import_module(module)
+    for a in attr.split("."):
+        obj=obj[a] if isinstance(obj, dict) else getattr(obj, a)
+    if isinstance(obj, re.Pattern):
+        # keep the pattern's flags inline, as `Scanner` does
+        pattern=obj.pattern
+        if isinstance(pattern, bytes):
+            pattern=pattern.decode("utf-8")
+        return _scope_flags(pattern, obj.flags)
+    return str(obj)
+
+def grep(paths, pattern, flags=0, jobs=None, chunk_size=64 << 20, overlap=64 << 10):
+    """
+    searches files through mmap with a bytes regex, split into chunks across
+    a process pool. memory use is bounded by the chunk size, not the file
+
+    matches longer than `overlap` that cross a chunk boundary are cut short.
+    matches don't overlap, as with a single `finditer` over the file: when a
+    match runs into the next chunk, that chunk is searched again from where
+    the match ended
+
+    Args:
+        paths       : the files to search
+        pattern     : a regex string (or `Node`), encoded as utf-8
+        flags       : re flags
+        jobs        : the number of processes, defaults to the number of cpus
+        chunk_size  : the number of bytes searched per task
+        overlap     : how far past its chunk a match may run
+
+    Yields:
+        (path, offset, match bytes), in file and offset order
+    """
+    if isinstance(pattern, Node):
+        pattern=pattern.pattern
+    if isinstance(pattern, str):
+        pattern=pattern.encode("utf-8")
+    tasks=(
+        (path, start, end, overlap, pattern, flags)
+        for path in paths
+        for start, end in _file_chunks(path, chunk_size)
+    )
+    if jobs==1:
+        yield from _merge_chunks(map(_grep_chunk, tasks), overlap, pattern, flags)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        yield from _merge_chunks(pool.imap(_grep_chunk, tasks), overlap, pattern, flags)
+
+def _merge_chunks(results, overlap, pattern, flags):
+    """the matches of ordered `_grep_chunk` results, without overlaps"""
+    last_end={}
+    for path, start, end, matches in results:
+        prev=last_end.get(path, 0)
+        if prev > start:
+            # the previous chunk's last match ran into this one, so this
+            # chunk's matches are aligned wrong - search again past it
+            matches=[] if prev >= end else _grep_chunk((path, prev, end, overlap, pattern, flags))[3]
+        for offset, text in matches:
+            yield path, offset, text
+        if matches:
+            offset, text=matches[-1]
+            last_end[path]=max(prev, offset+len(text))
+
+def get_parser():
+    parser=argparse.ArgumentParser(
+        description="search large files with a regexer pattern, through mmap and a process pool"
+    )
+    source=parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-e", "--regexp", help="a regular expression")
+    source.add_argument(
+        "-p", "--pattern", help="load a pattern from module:attribute, e.g. mypatterns:ATOM"
+    )
+    source.add_argument(
+        "-f", "--literals", help="a file of literals, one per line, matched with `trie`"
+    )
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("-i", "--ignore-case", action="store_true", default=False)
+    parser.add_argument("-c", "--count", action="store_true", default=False)
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=64 << 20)
+    parser.add_argument("--overlap", type=int, default=64 << 10)
+    parser.add_argument(
+        "--lint", action="store_true", default=False,
+        help="lint and fuzz the pattern first, and stop if it's prone to backtracking",
+    )
+    return parser
+
+def main(argv=None):
+    parser=get_parser()
+    args=parser.parse_args(argv)
+    if args.regexp:
+        pattern=args.regexp
+    elif args.pattern:
+        sys.path.insert(0, os.getcwd())
+        pattern=load_pattern(args.pattern)
+    else:
+        with open(args.literals) as fh:
+            literals=[l for l in fh.read().splitlines() if l]
+        if not literals:
+            parser.error(f"no literals in {args.literals}")
+        pattern=trie(literals)
+    flags=re.IGNORECASE if args.ignore_case else 0
+    if args.lint:
+        findings=lint(pattern, flags)+fuzz(pattern, flags)
+        for kind, message in findings:
+            print(f"{kind}: {message}", file=sys.stderr)
+        if findings:
+            return 2
+    counts=dict.fromkeys(args.files, 0)
+    out=sys.stdout.buffer
+    for path, offset, text in grep(
+        args.files, pattern, flags, args.jobs, args.chunk_size, args.overlap
+    ):
+        counts[path]+=1
+        if not args.count:
+            out.write(b"%s:%d:%s\n" % (path.encode(), offset, text))
+    if args.count:
+        for path, n in counts.items():
+            print(f"{path}:{n}")
+    out.flush()
+    return 0 if any(counts.values()) else 1
 
 
+if __name__ == "__main__":
+    sys.exit(main())